@@ -10,7 +10,7 @@ git config --bool core.bare false
 git checkout master
 
 # Python
-/usr/bin/python3.6 -m venv ./py3
+/usr/bin/python3.11 -m venv ./py3
 source py3/bin/activate
 pip install --upgrade pip
 pip install wheel
@@ -52,4 +52,4 @@ sudo luarocks install luasec
 sudo luarocks install lsqlite3
 
 # Couch stuff
-curl -HContent-Type:application/json -XPUT 'http://localhost:5984/_users/org.couchdb.user:stefan' --data-binary '{"_id": "org.couchdb.user:stefan","name": "stefan","roles": [],"type": "user","password": "xyzzy"}'
+curl -u admin:admin -HContent-Type:application/json -XPUT 'http://localhost:5984/_users/org.couchdb.user:stefan' --data-binary '{"_id": "org.couchdb.user:stefan","name": "stefan","roles": [],"type": "user","password": "xyzzy"}'
@@ -0,0 +1,57 @@
+import sys
+import argparse
+
+from sovoc.sovoc import Sovoc
+from sovoc.transfer import FORMATS, import_docs, export_docs
+
+def _open(database):
+    db = Sovoc(database)
+    found = db.conn.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='documents'").fetchone()
+    if not found:
+        db.setup()
+    return db
+
+def main(argv=None):
+    parser = argparse.ArgumentParser('python -m sovoc', description='Bulk import and export of sovoc databases.')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    importer = commands.add_parser('import', help='load NDJSON or a CouchDB _all_docs dump into a database')
+    importer.add_argument('database', help='sqlite database file, created if needed')
+    importer.add_argument('input', nargs='?', default='-', help='input file (default: stdin)')
+    importer.add_argument('--format', choices=FORMATS, default='ndjson')
+    importer.add_argument('--batch-size', type=int, default=10000, help='documents written per transaction')
+    importer.add_argument('--workers', type=int, default=None, help='parse/hash processes; 0 to work inline')
+    importer.add_argument('--no-new-edits', dest='new_edits', action='store_false', help='keep the _rev and _revisions given in the input')
+    importer.add_argument('--checkpoint', help='progress file, for resuming an interrupted import')
+
+    exporter = commands.add_parser('export', help='write the winning revisions of a database')
+    exporter.add_argument('database', help='sqlite database file')
+    exporter.add_argument('output', nargs='?', default='-', help='output file (default: stdout)')
+    exporter.add_argument('--format', choices=FORMATS, default='ndjson')
+    exporter.add_argument('--history', action='store_true', help='include _revisions with each document')
+
+    args = parser.parse_args(argv)
+    db = _open(args.database)
+
+    if args.command == 'import':
+        stream = sys.stdin.buffer if args.input == '-' else open(args.input, 'rb')
+        try:
+            count = import_docs(db, stream, fmt=args.format, batch_size=args.batch_size, workers=args.workers,
+                                new_edits=args.new_edits, checkpoint=args.checkpoint)
+        finally:
+            if stream is not sys.stdin.buffer:
+                stream.close()
+        print('imported {} documents'.format(count), file=sys.stderr)
+    else:
+        out = sys.stdout if args.output == '-' else open(args.output, 'w')
+        try:
+            count = export_docs(db, out, fmt=args.format, history=args.history)
+        finally:
+            if out is not sys.stdout:
+                out.close()
+        print('exported {} documents'.format(count), file=sys.stderr)
+
+    db.conn.close()
+
+if __name__ == '__main__':
+    main()
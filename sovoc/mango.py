@@ -1,3 +1,5 @@
+from sovoc.exceptions import SovocError
+
 def _operator(opstr):
     return {
         '$eq': '=',
@@ -91,6 +93,14 @@ class Mango:
                     else:
                         self.discriminants.append(['json_extract(body, "$.{0}")=?'.format(fkey), fval])
                         
+    def where(self):
+        # Just the selector, as a condition on the body column, for use in other statements
+        self._discriminant()
+        clause = ' AND '.join([term[0] for term in self.discriminants])
+        values = [term[1] for term in self.discriminants]
+        
+        return clause, values
+        
     def statement(self):
         fieldstr = ''
         self._fields()
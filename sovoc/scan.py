@@ -0,0 +1,85 @@
+from queue import Full
+from collections import deque
+
+class Scan:
+    """
+    Iterator over a long read, as returned by changes(), list(), conflicts()
+    and find().
+
+    Rows are produced by pages, a generator yielding lists of entries. Each
+    page is read either in a short transaction of its own, or from a
+    dedicated snapshot connection, so nothing is held open on the database's
+    shared connection while the consumer works through the rows.
+
+    Call close(), or use the scan as a context manager, to release it
+    before it is exhausted. A snapshot connection opened for the scan can be
+    handed over as conn, and is closed with it, whether or not any page was
+    ever read.
+    """
+    def __init__(self, pages, conn=None):
+        self.pages = pages
+        self.conn = conn
+        self.buffer = deque()
+        self.closed = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        while not self.buffer:
+            if self.closed:
+                raise StopIteration
+            try:
+                self.buffer.extend(next(self.pages))
+            except StopIteration:
+                self.close()
+                raise
+
+        return self.buffer.popleft()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.buffer.clear()
+        self.pages.close() # runs the generator's cleanup, if it was started
+        if self.conn:
+            self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __del__(self):
+        self.close()
+
+def window(pages, skip, limit):
+    """Drop the first skip entries from a generator of pages and stop after limit more"""
+    try:
+        for page in pages:
+            if skip >= len(page):
+                skip -= len(page)
+                continue
+            page = page[skip:]
+            skip = 0
+            if limit is not None:
+                page = page[:limit]
+                limit -= len(page)
+            if page:
+                yield page
+            if limit == 0:
+                return
+    finally:
+        pages.close()
+
+def put(queue, item, stop):
+    """Put item on a bounded queue, giving up if stop is set rather than blocking forever on a full queue"""
+    while not stop.is_set():
+        try:
+            queue.put(item, timeout=0.05)
+            return True
+        except Full:
+            pass
+    return False
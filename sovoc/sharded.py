@@ -0,0 +1,385 @@
+import os
+import json
+import zlib
+import heapq
+import base64
+import functools
+import itertools
+import threading
+
+from queue import Queue
+from concurrent.futures import ThreadPoolExecutor
+
+from sovoc.sovoc import Sovoc
+from sovoc.scan import Scan, window, put
+from sovoc.exceptions import SovocError
+
+def _shard_path(database, index):
+    # In-memory shards are simply separate in-memory databases
+    if database == ':memory:':
+        return database
+    stem, ext = os.path.splitext(database)
+    return '{0}.{1}{2}'.format(stem, index, ext)
+
+_END = object()
+
+def _drain(read, lock, tag, queue, stop, chunk):
+    # Runs in a worker thread: opens a shard's scan with read() and pushes (tag, batch, error)
+    # triples onto the queue. A batch of None marks the end of this shard's results. The
+    # shard's lock is only held while the scan reads, never while waiting on the queue.
+    scan = None
+    try:
+        with lock:
+            scan = read()
+        batch = []
+        while True:
+            with lock:
+                item = next(scan, _END)
+            if item is _END:
+                break
+            batch.append(item)
+            if len(batch) >= chunk:
+                if not put(queue, (tag, batch, None), stop):
+                    return
+                batch = []
+        if batch and not put(queue, (tag, batch, None), stop):
+            return
+        put(queue, (tag, None, None), stop)
+    except Exception as e:
+        put(queue, (tag, None, e), stop)
+    finally:
+        if scan is not None:
+            with lock:
+                scan.close()
+
+def _sql_rank(value):
+    # Mirror SQLite's ordering of storage classes: NULL < numbers < text < blobs
+    if value is None:
+        return (0, 0)
+    if isinstance(value, (int, float)):
+        return (1, value)
+    if isinstance(value, str):
+        return (2, value)
+    return (3, value)
+
+def _sort_key(sort):
+    # Turn a Mango 'sort' clause into a key function matching the per-shard ORDER BY
+    order = []
+    for sorter in sort:
+        for (field, direction) in sorter.items():
+            if direction.upper() in ['ASC', 'DESC']:
+                order.append((field, direction.upper() == 'DESC'))
+
+    def _cmp(a, b):
+        for (field, descending) in order:
+            x = _sql_rank(a.get(field))
+            y = _sql_rank(b.get(field))
+            if x != y:
+                result = -1 if x < y else 1
+                return -result if descending else result
+        return 0
+
+    return functools.cmp_to_key(_cmp)
+
+class ShardedSovoc:
+    """
+    A database hash-partitioned by _id across q separate Sovoc files, in the
+    spirit of CouchDB's q shards.
+
+    Single-document operations go to the owning shard. bulk() writes to all
+    affected shards in parallel, on a pool of q threads; note that each shard
+    commits independently, so a ConflictError from one shard does not roll
+    back the others. The error raised carries the outcome for every document
+    as its results. list(), changes() and find() scatter to every shard
+    concurrently, on a thread of their own per shard, and gather the results,
+    merging them into order where one is defined. They return a Scan, like a
+    single database's reads; closing it stops the shards' threads.
+
+    Each shard has a single connection, shared by all of these threads, so
+    every use of it holds the shard's lock: for the whole of a bulk()
+    transaction, and for each read a scan makes.
+    """
+    def __init__(self, database, q=8, chunk=1000, depth=4):
+        if q < 1:
+            raise SovocError('A sharded database needs at least one shard')
+
+        self.database = database
+        self.q = q
+        self.chunk = chunk
+        self.depth = depth # max number of chunks buffered per scatter queue
+
+        # Shard connections are driven from worker threads as well as the caller's
+        self.shards = [Sovoc(_shard_path(database, i), check_same_thread=False) for i in range(q)]
+        self.locks = [threading.Lock() for _ in range(q)]
+        self.pool = ThreadPoolExecutor(max_workers=q)
+
+    def setup(self):
+        for index in range(self.q):
+            self._call(index, 'setup')
+
+    def close(self):
+        self.pool.shutdown()
+        for (shard, lock) in zip(self.shards, self.locks):
+            with lock:
+                shard.conn.close()
+
+    def shard_index(self, docid):
+        return zlib.crc32(docid.encode('utf-8')) % self.q
+
+    def shard(self, docid):
+        return self.shards[self.shard_index(docid)]
+
+    def _call(self, index, method, *args, **kwargs):
+        # Run one of a shard's methods while holding that shard's lock
+        with self.locks[index]:
+            return getattr(self.shards[index], method)(*args, **kwargs)
+
+    def _route(self, docid, method, *args, **kwargs):
+        return self._call(self.shard_index(docid), method, *args, **kwargs)
+
+    # ==========================================================================
+    #  Combined sequence tokens
+    # ==========================================================================
+
+    def encode_seq(self, seqs):
+        payload = base64.urlsafe_b64encode(json.dumps(seqs).encode('utf-8')).decode('ascii')
+        return '{0}-{1}'.format(self.q, payload)
+
+    def decode_seq(self, token):
+        if not token:
+            return [None] * self.q
+
+        try:
+            q, payload = token.split('-', 1)
+            q = int(q)
+            seqs = json.loads(base64.urlsafe_b64decode(payload.encode('ascii')).decode('utf-8'))
+        except ValueError:
+            raise SovocError('Malformed sequence token')
+
+        if q != self.q or len(seqs) != self.q:
+            raise SovocError('Sequence token does not match shard count')
+
+        return seqs
+
+    # ==========================================================================
+    #  Scatter-gather
+    # ==========================================================================
+
+    def _read(self, index, method, *args, **kwargs):
+        # The (lock, read) pair that _drain uses to scan one shard
+        return self.locks[index], lambda: getattr(self.shards[index], method)(*args, **kwargs)
+
+    def _scatter(self, reads):
+        """Yield (position, item) pairs, position indexing reads, in whatever order the shards produce them"""
+        queue = Queue(maxsize=self.depth * len(reads))
+        stop = threading.Event()
+        for (tag, (lock, read)) in enumerate(reads):
+            threading.Thread(target=_drain, args=(read, lock, tag, queue, stop, self.chunk), daemon=True).start()
+
+        try:
+            remaining = len(reads)
+            while remaining:
+                tag, batch, error = queue.get()
+                if error:
+                    raise error
+                if batch is None:
+                    remaining -= 1
+                    continue
+                for item in batch:
+                    yield tag, item
+        finally:
+            stop.set()
+
+    def _paged(self, rows):
+        """Cut rows into pages for a Scan; closing the pages closes rows, stopping the shards' threads"""
+        try:
+            while True:
+                page = list(itertools.islice(rows, self.chunk))
+                if not page:
+                    return
+                yield page
+        finally:
+            if hasattr(rows, 'close'):
+                rows.close()
+
+    def _merge(self, reads, key, reverse=False):
+        """Merge per-shard results, each already sorted on key, into one sorted stream"""
+        stop = threading.Event()
+
+        def _stream(queue):
+            while True:
+                _, batch, error = queue.get()
+                if error:
+                    raise error
+                if batch is None:
+                    return
+                for item in batch:
+                    yield item
+
+        streams = []
+        for (tag, (lock, read)) in enumerate(reads):
+            queue = Queue(maxsize=self.depth)
+            threading.Thread(target=_drain, args=(read, lock, tag, queue, stop, self.chunk), daemon=True).start()
+            streams.append(_stream(queue))
+
+        try:
+            for item in heapq.merge(*streams, key=key, reverse=reverse):
+                yield item
+        finally:
+            stop.set()
+
+    # ==========================================================================
+    #  Routed operations
+    # ==========================================================================
+
+    def insert(self, doc, **kwargs):
+        docid = kwargs.get('_id', doc.get('_id'))
+        if not docid:
+            docid = kwargs['_id'] = Sovoc.gen_docid()
+        return self._route(docid, 'insert', doc, **kwargs)
+
+    def update(self, doc, **kwargs):
+        docid = kwargs.get('_id', doc.get('_id'))
+        if not docid:
+            raise SovocError('No _id given')
+        return self._route(docid, 'update', doc, **kwargs)
+
+    def destroy(self, docid, revid):
+        return self._route(docid, 'destroy', docid, revid)
+
+    def get(self, docid, revid=None):
+        return self._route(docid, 'get', docid, revid)
+
+    def open_revs(self, docid):
+        return self._route(docid, 'open_revs', docid)
+
+    def bulk(self, docs, **kwargs):
+        groups = {}
+        for (index, doc) in enumerate(docs):
+            if '_id' not in doc: # needed up front to pick a shard
+                doc['_id'] = Sovoc.gen_docid()
+            groups.setdefault(self.shard_index(doc['_id']), []).append(index)
+
+        futures = {}
+        for (shard, indices) in groups.items():
+            futures[shard] = self.pool.submit(self._call, shard, 'bulk', [docs[i] for i in indices], **kwargs)
+
+        # Every shard's outcome is collected before any error is raised, so that the
+        # caller can tell which documents were committed
+        result = [None] * len(docs)
+        failure = None
+        for (shard, future) in futures.items():
+            try:
+                entries = future.result()
+            except Exception as e:
+                failure = failure or e
+                entries = [ShardedSovoc._failed(docs[i]['_id'], e) for i in groups[shard]]
+            for (index, entry) in zip(groups[shard], entries):
+                result[index] = entry
+
+        if failure:
+            failure.results = result
+            raise failure
+
+        return result
+
+    @classmethod
+    def _failed(cls, docid, error):
+        # The entry for a document rolled back with its shard's failed bulk()
+        detail = error.args[0] if error.args and isinstance(error.args[0], dict) else {}
+        return {'id': docid, 'error': detail.get('error', 'bulk_failed'), 'reason': detail.get('reason', str(error))}
+
+    # ==========================================================================
+    #  Scatter-gather operations
+    # ==========================================================================
+
+    def changes(self, **kwargs):
+        """
+        Interleave the shards' feeds as they arrive. Each entry's seq is a
+        combined token recording the position reached in every shard, so
+        passing it back as seq resumes each shard independently.
+        """
+        seqs = self.decode_seq(kwargs.pop('seq', None))
+        kwargs.setdefault('chunk', self.chunk)
+
+        reads = [self._read(i, 'changes', seq=seqs[i], **kwargs) for i in range(self.q)]
+
+        def _entries(rows):
+            try:
+                for (tag, entry) in rows:
+                    seqs[tag] = entry['seq']
+                    entry['seq'] = self.encode_seq(seqs)
+                    yield entry
+            finally:
+                rows.close()
+
+        return Scan(self._paged(_entries(self._scatter(reads))))
+
+    def info(self):
+        # Counters add up across shards; update_seq becomes a combined token like those of changes()
+        result = {'db_name': self.database, 'q': self.q}
+        seqs = []
+        for index in range(self.q):
+            info = self._call(index, 'info')
+            seqs.append(info.pop('update_seq'))
+            info.pop('db_name')
+            for (name, value) in info.items():
+                result[name] = result.get(name, 0) + value
+        result['update_seq'] = self.encode_seq(seqs)
+
+        return result
+
+    def total_rows(self):
+        return sum(self._call(index, 'total_rows') for index in range(self.q))
+
+    def conflicts(self, **kwargs):
+        reads = [self._read(i, 'conflicts', **kwargs) for i in range(self.q)]
+        rows = self._merge(reads, key=lambda doc: doc['_id'])
+        return Scan(window(self._paged(rows), 0, kwargs.get('limit', None)))
+
+    def list(self, **kwargs):
+        keys = kwargs.pop('keys', [])
+        skip = kwargs.pop('skip', 0)
+        limit = kwargs.pop('limit', None)
+
+        if keys:
+            # Report rows in the order the keys were asked for, wherever they live. A
+            # shard returns one row per key it is given, in order, so each of its rows
+            # belongs at the position in keys of the matching key.
+            groups = {}
+            for (position, key) in enumerate(keys):
+                groups.setdefault(self.shard_index(key), []).append(position)
+            reads = [self._read(i, 'list', keys=[keys[p] for p in positions], **kwargs) for (i, positions) in groups.items()]
+            positions = list(groups.values())
+
+            rows = [None] * len(keys)
+            seen = [0] * len(positions)
+            for (tag, entry) in self._scatter(reads):
+                rows[positions[tag][seen[tag]]] = entry
+                seen[tag] += 1
+
+            return Scan(window(self._paged(iter(rows)), skip, limit))
+
+        # Every shard may hold rows of the requested page, so each one is asked
+        # for skip+limit rows and the page is cut from the merged stream.
+        if limit is not None:
+            kwargs['limit'] = skip + limit
+        reads = [self._read(i, 'list', **kwargs) for i in range(self.q)]
+
+        rows = self._merge(reads, key=lambda entry: entry['key'], reverse=kwargs.get('descending', False))
+        return Scan(window(self._paged(rows), skip, limit))
+
+    def find(self, query, chunk=1000):
+        reads = [self._read(i, 'find', query, chunk) for i in range(self.q)]
+
+        if 'sort' in query:
+            return Scan(self._paged(self._merge(reads, key=_sort_key(query['sort']))))
+
+        def _rows(rows):
+            try:
+                for (_, row) in rows:
+                    yield row
+            finally:
+                rows.close()
+
+        return Scan(self._paged(_rows(self._scatter(reads))))
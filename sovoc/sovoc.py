@@ -1,5 +1,10 @@
+import io
+import os
 import json
+import base64
 import sqlite3
+import tempfile
+import urllib.request
 import marshal
 import hashlib
 import uuid
@@ -7,6 +12,10 @@ import time
 
 from sovoc.exceptions import SovocError, ConflictError
 from sovoc.mango import Mango
+from sovoc.views import View, collate
+from sovoc.scan import Scan, window
+
+KEYS_CHUNK = 500 # keys looked up per statement by list(keys=...)
 
 SCHEMA = [ # TODO: add explicit INTEGER PRIMARY KEY instead of relying on rowid, which may change on vacuum
     '''
@@ -20,6 +29,10 @@ SCHEMA = [ # TODO: add explicit INTEGER PRIMARY KEY instead of relying on rowid,
       UNIQUE (_id, _rev) ON CONFLICT IGNORE
     )''',
     
+    '''
+    CREATE INDEX leaves_idx ON documents (_id, leaf, _deleted, generation, _rev)
+    ''',
+    
     '''
     CREATE TABLE ancestors (
         -- Table holding the document tree structure
@@ -44,24 +57,68 @@ SCHEMA = [ # TODO: add explicit INTEGER PRIMARY KEY instead of relying on rowid,
     CREATE INDEX seq_idx ON changes (seq)
     ''',
     
+    '''
+    CREATE INDEX changes_doc_row_idx ON changes (doc_row)
+    ''',
+    
     '''
     CREATE VIEW changes_feed AS
       SELECT c.seq, d.rowid AS doc_row, d._deleted, d._id, d._rev
       FROM changes c, documents d
       WHERE c.doc_row = d.rowid
       ORDER BY d.rowid
+    ''',
+    
+    '''
+    CREATE TABLE views (
+        -- One row per materialized view: the signature of its
+        -- map/reduce definition and the last seq it has processed
+      name TEXT PRIMARY KEY,
+      signature TEXT NOT NULL,
+      seq TEXT
+    )''',
+    
     '''
+    CREATE TABLE blobs (
+        -- Attachment content, addressed by digest so that
+        -- revisions and documents sharing an attachment
+        -- share a single stored copy
+      digest TEXT PRIMARY KEY,
+      length INTEGER NOT NULL CHECK (length >= 0),
+      data BLOB NOT NULL
+    )''',
+    
+    '''
+    CREATE TABLE counters (
+        -- Database-wide totals maintained by bulk(),
+        -- so that they can be read without a scan
+      name TEXT PRIMARY KEY,
+      value INTEGER NOT NULL DEFAULT 0
+    )''',
+    
+    '''
+    INSERT INTO counters (name, value) VALUES
+      ('doc_count', 0), ('doc_del_count', 0), ('doc_conflict_count', 0),
+      ('rev_count', 0), ('data_size', 0), ('attachment_size', 0)
+    ''',
+    
+    '''
+    CREATE TABLE conflicts (
+        -- Index of the documents with more than one
+        -- non-deleted leaf, maintained by bulk()
+      _id TEXT PRIMARY KEY
+    ) WITHOUT ROWID'''
 ]
 
 class Sovoc:
-    def __init__(self, database):
+    def __init__(self, database, **kwargs):
         self.database = database
         self.conn = None
         attempts = 0
         
         while not self.conn and attempts < 5:
             try:
-                self.conn = sqlite3.connect(self.database)
+                self.conn = sqlite3.connect(self.database, **kwargs)
             except sqlite3.OperationalError:
                 attempts += 1
                 time.sleep(0.001)
@@ -70,13 +127,39 @@ class Sovoc:
             raise sqlite3.OperationalError("Can't connect to sqlite database {}".format(database))
             
         self.conn.row_factory = sqlite3.Row
+        self.conn.create_collation('couchjson', collate)
+        self.views = {}
         
     def setup(self):
+        if self.database != ':memory:':
+            # Readers and the writer don't block each other in WAL mode; the setting is kept in the file
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            
         with self.conn:
             c = self.conn.cursor()
             for statement in SCHEMA:
                 c.execute(statement)
 
+    def snapshot(self):
+        """
+        A new read-only connection holding a read transaction, through which the database is
+        seen as it was when this was called, until the connection is closed. Not available for
+        in-memory databases.
+        """
+        if self.database == ':memory:':
+            raise SovocError('In-memory databases have no snapshot connections')
+            
+        uri = 'file:{}?mode=ro'.format(urllib.request.pathname2url(os.path.abspath(self.database)))
+        conn = sqlite3.connect(uri, uri=True, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        conn.create_collation('couchjson', collate)
+        
+        # BEGIN is deferred: the snapshot is fixed by the first read
+        conn.execute('BEGIN')
+        conn.execute('SELECT 1 FROM counters').fetchone()
+        
+        return conn
+        
     @classmethod
     def gen_revid(cls, generation, body):
         body.pop('_id', None)
@@ -85,6 +168,26 @@ class Sovoc:
         m.update(marshal.dumps(body))
         return '{0}-{1}'.format(generation, m.hexdigest())
         
+    @classmethod
+    def generation(cls, revid):
+        try:
+            return int(revid.split('-', 1)[0])
+        except ValueError:
+            raise SovocError({'error': 'bad_request', 'reason': 'Invalid rev format'})
+        
+    @classmethod
+    def rev_key(cls, revid):
+        # Sort key ordering revisions as CouchDB picks winners: by generation, then by hash
+        return (Sovoc.generation(revid), revid)
+        
+    @classmethod
+    def seq_row(cls, seq):
+        # A change's seq is '<documents rowid>-<batch id>'; the rowid is where a read of the feed resumes
+        try:
+            return int(str(seq).split('-', 1)[0])
+        except ValueError:
+            raise SovocError({'error': 'bad_request', 'reason': 'Invalid seq: {}'.format(seq)})
+        
     @classmethod
     def gen_docid(cls):
         return uuid.uuid4().hex
@@ -124,60 +227,288 @@ class Sovoc:
         return result[0]
         
     def bulk(self, docs, **kwargs):
-
-        insert_document = 'INSERT INTO documents (_id, _rev, _deleted, generation, leaf, body) VALUES (?, ?, ?, ?, 1, json(?))'
-        find_parent = 'SELECT rowid, generation FROM documents WHERE _id=? AND _rev=? AND _deleted=0'
-        get_last_insert = 'SELECT last_insert_rowid()'
-        ancestral_identity = 'INSERT INTO ancestors (ancestor, descendant, depth) VALUES (?, ?, ?)'
-        ancestral_closure = 'INSERT INTO ancestors (ancestor, descendant, depth) SELECT ancestor, ?, depth+1 FROM ancestors WHERE descendant=?'
-        make_parent_internal = 'UPDATE documents SET leaf=0 WHERE rowid=?'
+        """
+        See: http://docs.couchdb.org/en/2.0.0/api/database/bulk-api.html#db-bulk-docs
+        
+        With new_edits=False, as used in replication, each document's _rev (and the history
+        in its _revisions, if any) is stored as given rather than generated.
+        """
+        new_edits = kwargs.get('new_edits', True)
+        
         changes_feed = 'INSERT INTO changes (doc_row, seq) VALUES (?, ?)'
+        leaf_state = 'SELECT COUNT(*) AS leaves, COALESCE(SUM(_deleted=0), 0) AS live FROM documents WHERE _id=? AND leaf=1'
+        mark_conflicted = 'INSERT OR IGNORE INTO conflicts (_id) VALUES (?)'
+        unmark_conflicted = 'DELETE FROM conflicts WHERE _id=?'
+        last_row = 'SELECT COALESCE(MAX(rowid), 0) AS rowid FROM documents'
+        new_revisions = 'SELECT COUNT(*) AS revs, COALESCE(SUM(LENGTH(CAST(body AS BLOB))), 0) AS size FROM documents WHERE rowid>?'
+        update_counter = 'UPDATE counters SET value=value+? WHERE name=?'
         
         seq = uuid.uuid4().hex # for now
 
         result = []
+        counts = {'doc_count': 0, 'doc_del_count': 0, 'doc_conflict_count': 0}
         
         with self.conn:
             c = self.conn.cursor()
+            if not self.conn.in_transaction:
+                # sqlite3 would only begin at the first INSERT; the reads below must see what
+                # this transaction writes on top of, with no other writer in between
+                c.execute('BEGIN IMMEDIATE')
+            first_row = c.execute(last_row).fetchone()['rowid']
+            
             for doc in docs:
-                generation = 1
-                parent_row = None
                 docid = doc.get('_id', Sovoc.gen_docid())
-                parent_revid = doc.get('_rev', None)
-                deleted = doc.get('_deleted', False)
-                                
-                if parent_revid:
-                    c.execute(find_parent, [docid, parent_revid])
-                    parent = c.fetchone()
-                
-                    if not parent:
-                        raise ConflictError({'error': 'conflict', 'reason': 'Document update conflict.'})
-                    
-                    parent_row = parent['rowid']
-                    generation = parent['generation'] + 1
-                
-                revid = Sovoc.gen_revid(generation, doc) # TODO: is this correct, or will doc be stripped of any _id, _revs?
+                before = c.execute(leaf_state, [docid]).fetchone()
                 
-                # Store the document itself
-                doc.update({'_id': docid, '_rev': revid})
-                c.execute(insert_document, [docid, revid, 1 if deleted else 0, generation, json.dumps(doc)])
-                doc_rowid = self._insert_id(c)
-            
-                # Insert the indentity relation in the ancestors table
-                c.execute(ancestral_identity, [doc_rowid, doc_rowid, 0])
-                if parent_revid:
-                    # As we have at least one ancestral node, we need to complete the closures for this branch
-                    c.execute(ancestral_closure, [doc_rowid, parent_row]) 
-                    # ... and also ensure that we record that the direct parent is no longer a leaf
-                    c.execute(make_parent_internal, [parent_row])
+                if new_edits:
+                    revid, doc_rowid = self._new_edit(c, docid, doc)
+                else:
+                    revid, doc_rowid = self._replicated_edit(c, docid, doc)
                 
-                # Record the change
-                c.execute(changes_feed, [doc_rowid, seq])
+                if doc_rowid:
+                    # Record the change
+                    c.execute(changes_feed, [doc_rowid, seq])
+                    
+                    # ...and keep the per-document tallies and the conflict index current
+                    after = c.execute(leaf_state, [docid]).fetchone()
+                    for (name, delta) in Sovoc._state_deltas(before, after):
+                        counts[name] += delta
+                    if after['live'] > 1:
+                        c.execute(mark_conflicted, [docid])
+                    elif before['live'] > 1:
+                        c.execute(unmark_conflicted, [docid])
             
                 result.append({'ok': True, 'id': docid, 'rev': revid})
                 
+            # Every revision written above, stubs included, has a rowid past first_row
+            written = c.execute(new_revisions, [first_row]).fetchone()
+            counts['rev_count'] = written['revs']
+            counts['data_size'] = written['size']
+            
+            for (name, delta) in counts.items():
+                if delta:
+                    c.execute(update_counter, [delta, name])
+                
         return result
         
+    @classmethod
+    def _state_deltas(cls, before, after):
+        # A document is live if it has a non-deleted leaf, deleted if all its leaves are
+        # deleted, and in conflict if it has more than one non-deleted leaf
+        def _states(leaf_state):
+            return {
+                'doc_count': 1 if leaf_state['live'] else 0,
+                'doc_del_count': 1 if leaf_state['leaves'] and not leaf_state['live'] else 0,
+                'doc_conflict_count': 1 if leaf_state['live'] > 1 else 0
+            }
+            
+        was = _states(before)
+        now = _states(after)
+        
+        return [(name, now[name] - was[name]) for name in now]
+        
+    def _new_edit(self, cursor, docid, doc):
+        find_parent = 'SELECT rowid, generation FROM documents WHERE _id=? AND _rev=? AND _deleted=0'
+        
+        generation = 1
+        parent_row = None
+        parent_revid = doc.get('_rev', None)
+        deleted = doc.get('_deleted', False)
+                        
+        if parent_revid:
+            cursor.execute(find_parent, [docid, parent_revid])
+            parent = cursor.fetchone()
+        
+            if not parent:
+                raise ConflictError({'error': 'conflict', 'reason': 'Document update conflict.'})
+            
+            parent_row = parent['rowid']
+            generation = parent['generation'] + 1
+        
+        if '_attachments' in doc:
+            self._store_attachments(cursor, doc, generation, parent_row)
+        
+        revid = Sovoc.gen_revid(generation, doc) # TODO: is this correct, or will doc be stripped of any _id, _revs?
+        
+        # Store the document itself
+        doc.update({'_id': docid, '_rev': revid})
+        doc_rowid = self._insert_revision(cursor, docid, revid, deleted, generation, 1, json.dumps(doc), parent_row)
+        
+        return revid, doc_rowid
+        
+    def _replicated_edit(self, cursor, docid, doc):
+        # Ancestors named in _revisions that we don't hold yet are stored as body-less internal
+        # nodes, so that the branch can be extended later. Returns no rowid for a revision we already have.
+        find_revision = 'SELECT rowid FROM documents WHERE _id=? AND _rev=?'
+        
+        revid = doc.get('_rev', None)
+        if not revid:
+            raise SovocError({'error': 'bad_request', 'reason': 'Documents must have a _rev when new_edits is false'})
+            
+        revisions = doc.pop('_revisions', None)
+        revs = [revid]
+        if revisions:
+            revs = ['{0}-{1}'.format(revisions['start'] - i, rev) for (i, rev) in enumerate(revisions['ids'])]
+            if revs[0] != revid:
+                raise SovocError({'error': 'bad_request', 'reason': '_rev does not match _revisions'})
+        
+        if cursor.execute(find_revision, [docid, revid]).fetchone():
+            return revid, None
+            
+        parent_row = None
+        for rev in reversed(revs[1:]):
+            ancestor = cursor.execute(find_revision, [docid, rev]).fetchone()
+            if ancestor:
+                parent_row = ancestor['rowid']
+            else:
+                parent_row = self._insert_revision(cursor, docid, rev, False, Sovoc.generation(rev), 0, None, parent_row)
+            
+        generation = Sovoc.generation(revid)
+        if '_attachments' in doc:
+            self._store_attachments(cursor, doc, generation, parent_row)
+            
+        doc['_id'] = docid
+        doc_rowid = self._insert_revision(cursor, docid, revid, doc.get('_deleted', False), generation, 1, json.dumps(doc), parent_row)
+        
+        return revid, doc_rowid
+        
+    def _insert_revision(self, cursor, docid, revid, deleted, generation, leaf, body, parent_row):
+        insert_document = 'INSERT INTO documents (_id, _rev, _deleted, generation, leaf, body) VALUES (?, ?, ?, ?, ?, json(?))'
+        ancestral_identity = 'INSERT INTO ancestors (ancestor, descendant, depth) VALUES (?, ?, ?)'
+        ancestral_closure = 'INSERT INTO ancestors (ancestor, descendant, depth) SELECT ancestor, ?, depth+1 FROM ancestors WHERE descendant=?'
+        make_parent_internal = 'UPDATE documents SET leaf=0 WHERE rowid=?'
+        
+        cursor.execute(insert_document, [docid, revid, 1 if deleted else 0, generation, leaf, body])
+        doc_rowid = self._insert_id(cursor)
+    
+        # Insert the indentity relation in the ancestors table
+        cursor.execute(ancestral_identity, [doc_rowid, doc_rowid, 0])
+        if parent_row:
+            # As we have at least one ancestral node, we need to complete the closures for this branch
+            cursor.execute(ancestral_closure, [doc_rowid, parent_row]) 
+            # ... and also ensure that we record that the direct parent is no longer a leaf
+            cursor.execute(make_parent_internal, [parent_row])
+            
+        return doc_rowid
+        
+    def _store_blob(self, cursor, data, chunk=65536):
+        # data is either a bytes-like object or a file-like object with read().
+        # Streams are digested while spooling, so that content we already hold is never written twice.
+        m = hashlib.md5()
+        if hasattr(data, 'read'):
+            source = tempfile.SpooledTemporaryFile(max_size=chunk*16)
+            length = 0
+            while True:
+                block = data.read(chunk)
+                if not block:
+                    break
+                m.update(block)
+                source.write(block)
+                length += len(block)
+            source.seek(0)
+        else:
+            m.update(data)
+            source = io.BytesIO(data)
+            length = len(data)
+            
+        digest = 'md5-{}'.format(base64.b64encode(m.digest()).decode('ascii'))
+        
+        cursor.execute('INSERT OR IGNORE INTO blobs (digest, length, data) VALUES (?, ?, zeroblob(?))', [digest, length, length])
+        if cursor.rowcount == 1:
+            blob_row = cursor.lastrowid
+            cursor.execute('UPDATE counters SET value=value+? WHERE name=?', [length, 'attachment_size'])
+            with self.conn.blobopen('blobs', 'data', blob_row) as blob:
+                while True:
+                    block = source.read(chunk)
+                    if not block:
+                        break
+                    blob.write(block)
+                    
+        source.close()
+        
+        return digest, length
+        
+    def _store_attachments(self, cursor, doc, generation, parent_row):
+        # Replace the _attachments of a document about to be written with stubs: inline base64
+        # data is moved into the blobs table, and stubs are resolved against the parent revision.
+        get_parent_body = 'SELECT body FROM documents WHERE rowid=?'
+        find_blob = 'SELECT 1 FROM blobs WHERE digest=?'
+        
+        parent_attachments = {}
+        if parent_row:
+            cursor.execute(get_parent_body, [parent_row])
+            body = cursor.fetchone()['body']
+            if body: # ancestors stored by replication have no body
+                parent_attachments = json.loads(body).get('_attachments', {})
+        
+        stubs = {}
+        for (name, attachment) in doc['_attachments'].items():
+            if 'data' in attachment:
+                digest, length = self._store_blob(cursor, base64.b64decode(attachment['data']))
+            elif attachment.get('stub', False):
+                inherited = parent_attachments.get(name)
+                if inherited and attachment.get('digest', inherited['digest']) == inherited['digest']:
+                    stubs[name] = inherited
+                    continue
+                    
+                digest, length = attachment.get('digest'), attachment.get('length')
+                if not digest or not cursor.execute(find_blob, [digest]).fetchone():
+                    raise SovocError({'error': 'missing_stub', 'reason': 'No attachment content for {}'.format(name)})
+            else:
+                raise SovocError({'error': 'bad_request', 'reason': 'Attachment {} has neither data nor stub'.format(name)})
+                
+            stubs[name] = {
+                'content_type': attachment.get('content_type', 'application/octet-stream'),
+                'digest': digest,
+                'length': length,
+                'revpos': generation,
+                'stub': True
+            }
+            
+        doc['_attachments'] = stubs
+        
+    def put_attachment(self, docid, revid, name, data, content_type='application/octet-stream', chunk=65536):
+        """
+        Add or replace an attachment, creating a new revision of the document. data
+        may be bytes or a file-like object, which is streamed into the database in chunks.
+        See: http://docs.couchdb.org/en/2.0.0/api/document/attachments.html#put--db-docid-attname
+        """
+        if revid:
+            doc = self.get(docid, revid)
+        else:
+            doc = {'_id': docid or Sovoc.gen_docid()}
+            
+        with self.conn:
+            c = self.conn.cursor()
+            digest, length = self._store_blob(c, data, chunk)
+            doc.setdefault('_attachments', {})[name] = {'content_type': content_type, 'digest': digest, 'length': length, 'stub': True}
+            result = self.bulk([doc])
+            
+        return result[0]
+        
+    def attachment(self, docid, name, revid=None, chunk=65536):
+        """
+        Returns a generator yielding the attachment content in chunks, read incrementally from the blobs table.
+        """
+        find_blob = 'SELECT rowid FROM blobs WHERE digest=?'
+        
+        doc = self.get(docid, revid)
+        stub = doc.get('_attachments', {}).get(name)
+        if not stub:
+            raise SovocError({'error': 'not_found', 'reason': 'Document is missing attachment'})
+            
+        row = self.conn.execute(find_blob, [stub['digest']]).fetchone()
+        
+        return self._read_blob(row['rowid'], chunk)
+        
+    def _read_blob(self, rowid, chunk):
+        with self.conn.blobopen('blobs', 'data', rowid, readonly=True) as blob:
+            while True:
+                block = blob.read(chunk)
+                if not block:
+                    break
+                yield block
+        
     def destroy(self, docid, revid):
         return self.insert({}, _id=docid, _rev=revid, _deleted=True)
             
@@ -211,7 +542,7 @@ class Sovoc:
         with self.conn:
             c = self.conn.cursor()
             if revid: # specific rev is the simple case.
-                c.excute(get_specific_rev, [docid, revid])
+                c.execute(get_specific_rev, [docid, revid])
             else:
                 c.execute(get_winner, [docid])
                 
@@ -221,33 +552,156 @@ class Sovoc:
             
             
     def changes(self, **kwargs):
+        """
+        See: http://docs.couchdb.org/en/2.0.0/api/database/changes.html
+        
+        Filtering is done in SQL: filter='_doc_ids' with doc_ids=[...], or filter='_selector'
+        with a Mango selector=. include_docs=True adds the bodies from the same query, and
+        style='all_docs' lists every leaf revision. dedupe=True reports only the latest
+        change to each document instead of replaying every intermediate revision.
+        
+        Each entry's seq marks its own position in the feed, so passing it back as seq
+        resumes right after that entry, even part-way through the changes of one bulk().
+        """
         seq = kwargs.get('seq', None)
         chunk = kwargs.get('chunk', 1000)
+        feed_filter = kwargs.get('filter', None)
+        include_docs = kwargs.get('include_docs', False)
+        style = kwargs.get('style', 'main_only')
+        dedupe = kwargs.get('dedupe', False)
+        
+        fields = 'c.seq, d._deleted, d._id, d._rev'
+        if include_docs:
+            fields += ', d.body'
+        if style == 'all_docs':
+            fields += ", (SELECT json_group_array(_rev) FROM documents WHERE _id=d._id AND leaf=1) AS leaves"
+        elif style != 'main_only':
+            raise SovocError({'error': 'bad_request', 'reason': 'Unknown style: {}'.format(style)})
+        
+        get_hwm = 'SELECT MAX(rowid) AS hwm FROM documents'
         
-        get_changes = 'SELECT * FROM changes_feed WHERE doc_row > (SELECT MIN(rowid) FROM changes WHERE seq=?)'
-        get_changes_all = 'SELECT * FROM changes_feed'
-
         with self.conn:
-            c = self.conn.cursor()
-            if seq:
-                c.execute(get_changes, [seq])
-            else:
-                c.execute(get_changes_all)
+            hwm = self.conn.execute(get_hwm).fetchone()['hwm'] or 0
+            
+        # The feed is read in keyset-paged chunks up to the last row present now. Rows
+        # are never altered once written, so the pages together form a consistent snapshot.
+        start = Sovoc.seq_row(seq) if seq else 0
+        
+        # Bounded and ordered on changes.doc_row, so each page is a seek into its index
+        clauses = ['c.doc_row > ?', 'c.doc_row <= ?']
+        values = []
+            
+        if feed_filter == '_doc_ids':
+            # Passed as a single json array, so any number of ids binds to one parameter
+            clauses.append('d._id IN (SELECT value FROM json_each(?))')
+            values.append(json.dumps(kwargs.get('doc_ids', [])))
+        elif feed_filter == '_selector':
+            selector, selector_values = Mango({'selector': kwargs.get('selector', {})}).where()
+            if selector:
+                clauses.append(selector)
+                values.extend(selector_values)
+        elif feed_filter:
+            raise SovocError({'error': 'bad_request', 'reason': 'Unknown filter: {}'.format(feed_filter)})
+            
+        if dedupe:
+            clauses.append('d.rowid = (SELECT MAX(rowid) FROM documents WHERE _id=d._id AND rowid <= ?)')
+            values.append(hwm)
+            
+        get_changes = 'SELECT {0}, d.rowid AS doc_row FROM changes c JOIN documents d ON (c.doc_row = d.rowid) WHERE {1} ORDER BY c.doc_row LIMIT ?'.format(fields, ' AND '.join(clauses))
+        
+        def _entry(row):
+            entry = {'seq': '{0}-{1}'.format(row['doc_row'], row['seq']), 'id': row['_id'], 'rev': row['_rev']}
+            if row['_deleted'] == 1:
+                entry['deleted'] = True
+            if include_docs:
+                entry['doc'] = json.loads(row['body'])
+            if style == 'all_docs':
+                leaves = sorted(json.loads(row['leaves']), key=Sovoc.rev_key, reverse=True)
+                entry['changes'] = [{'rev': rev} for rev in leaves]
+            return entry
+            
+        def _pages(after):
+            while after is not None and after < hwm:
+                with self.conn:
+                    results = self.conn.execute(get_changes, [after, hwm] + values + [chunk]).fetchall()
+                if not results:
+                    break
+                yield [_entry(row) for row in results]
+                after = results[-1]['doc_row']
                 
-            while True:
-                results = c.fetchmany(chunk)
+        return Scan(_pages(start))
+                    
+    def info(self):
+        """
+        See: http://docs.couchdb.org/en/2.0.0/api/database/common.html#get--db
+        
+        Read from the counters maintained by bulk(), so this costs the same for any size of database.
+        """
+        get_counters = 'SELECT name, value FROM counters'
+        get_update_seq = 'SELECT doc_row, seq FROM changes ORDER BY rowid DESC LIMIT 1'
+        
+        with self.conn:
+            result = {'db_name': self.database}
+            for row in self.conn.execute(get_counters):
+                result[row['name']] = row['value']
+            row = self.conn.execute(get_update_seq).fetchone()
+            result['update_seq'] = '{0}-{1}'.format(row['doc_row'], row['seq']) if row else None
+            
+        return result
+        
+    def total_rows(self):
+        """
+        Number of live (non-deleted) documents, read from the counter maintained by bulk().
+        """
+        get_counter = 'SELECT value FROM counters WHERE name=?'
+        
+        return self.conn.execute(get_counter, ['doc_count']).fetchone()['value']
+        
+    def conflicts(self, **kwargs):
+        """
+        The documents in conflict, in _id order, each with its winning _rev and the other
+        non-deleted leaves as _conflicts. Read from the conflict index, so documents
+        without conflicts are never visited. Page with startkey and limit.
+        """
+        chunk = kwargs.get('chunk', 1000)
+        limit = kwargs.get('limit', None)
+        
+        get_conflicts = '''
+          SELECT c._id, d._rev FROM (SELECT _id FROM conflicts WHERE _id{0}? ORDER BY _id LIMIT ?) c
+          JOIN documents d ON (d._id = c._id AND d.leaf=1 AND d._deleted=0)
+          ORDER BY c._id, d.generation DESC, d._rev DESC'''
+        
+        def _pages(after, remaining):
+            # Page through the index by _id, one short transaction per page
+            comparison = '>=' if 'startkey' in kwargs else '>'
+            while remaining is None or remaining > 0:
+                size = chunk if remaining is None else min(chunk, remaining)
+                with self.conn:
+                    results = self.conn.execute(get_conflicts.format(comparison), [after, size]).fetchall()
                 if not results:
                     break
                     
+                page = []
                 for row in results:
-                    entry = {'seq': row['seq'], 'id': row['_id'], 'rev': row['_rev']}
-                    if row['_deleted'] == 1:
-                        entry['deleted'] = True
-                    yield entry
+                    if page and page[-1]['_id'] == row['_id']:
+                        page[-1]['_conflicts'].append(row['_rev'])
+                    else:
+                        page.append({'_id': row['_id'], '_rev': row['_rev'], '_conflicts': []})
+                yield page
+                
+                after = page[-1]['_id']
+                comparison = '>'
+                if remaining is not None:
+                    remaining -= len(page)
                     
+        return Scan(_pages(kwargs.get('startkey', ''), limit))
+        
     def list(self, **kwargs):
         """
         See: http://docs.couchdb.org/en/2.0.0/api/database/bulk-api.html#db-all-docs
+        
+        Rows are ordered by _id and read with an index range scan, so a page costs the
+        same wherever it starts: pass the last id seen as startkey, with skip=1.
         """
         include_docs = kwargs.get('include_docs', False)
         conflicts = kwargs.get('conflicts', False)
@@ -256,43 +710,128 @@ class Sovoc:
             
         chunk = kwargs.get('chunk', 1000)        
         keys = kwargs.get('keys', [])
+        descending = kwargs.get('descending', False)
+        inclusive_end = kwargs.get('inclusive_end', True)
+        limit = kwargs.get('limit', None)
+        skip = kwargs.get('skip', 0)
         
-        fields = '_id, _rev'
+        fields = 'd._id, d._rev'
         if include_docs:
-            fields = '_id, _rev, body'
+            fields = 'd._id, d._rev, d.body'
             
-        get_winners = 'SELECT {} FROM documents WHERE leaf=1 AND _deleted=0 ORDER BY generation DESC, _rev DESC'.format(fields)
+        if keys:
+            return Scan(window(self._list_keys(fields, keys, conflicts), skip, limit))
+            
+        if conflicts:
+            # The other leaves are only looked up for documents in the conflict index
+            fields += ''', CASE WHEN EXISTS (SELECT 1 FROM conflicts WHERE _id=d._id)
+              THEN (SELECT json_group_array(_rev) FROM documents WHERE _id=d._id AND leaf=1 AND _deleted=0 AND rowid!=d.rowid)
+              END AS conflicts'''
+            
+        clauses = []
+        values = []
         
-        keyed_param_bindings = ','.join(['?']*len(keys))
-        get_keyed_winners = 'SELECT {0} FROM documents WHERE leaf=1 AND _deleted=0 AND _id IN ({1}) ORDER BY generation DESC, _rev DESC'.format(fields, keyed_param_bindings)
-
-        with self.conn:
-            c = self.conn.cursor()
-            if keys:
-                c.execute(get_keyed_winners, keys)
-            else:
-                c.execute(get_winners)
-                
-            current_id = None
+        # As in CouchDB, startkey is the high end of a descending range
+        low, high = ('endkey', 'startkey') if descending else ('startkey', 'endkey')
+        if low in kwargs:
+            inclusive = inclusive_end or low == 'startkey'
+            clauses.append(' AND d._id>=?' if inclusive else ' AND d._id>?')
+            values.append(kwargs[low])
+        if high in kwargs:
+            inclusive = inclusive_end or high == 'startkey'
+            clauses.append(' AND d._id<=?' if inclusive else ' AND d._id<?')
+            values.append(kwargs[high])
+            
+        order = 'd._id DESC' if descending else 'd._id'
         
-            while True:
-                results = c.fetchmany(chunk)
+        get_winners = '''
+          SELECT {0} FROM documents d WHERE d.leaf=1 AND d._deleted=0{1}
+          AND d.rowid=(SELECT rowid FROM documents WHERE _id=d._id AND leaf=1 AND _deleted=0 ORDER BY generation DESC, _rev DESC LIMIT 1)
+          ORDER BY {2} LIMIT ? OFFSET ?'''
+        get_first = get_winners.format(fields, ''.join(clauses), order)
+        # Later pages resume after the last _id seen
+        get_next = get_winners.format(fields, ''.join(clauses) + (' AND d._id<?' if descending else ' AND d._id>?'), order)
+        
+        def _entry(row):
+            entry = Sovoc._list_entry(row)
+            if conflicts and row['conflicts']:
+                entry['doc']['_conflicts'] = sorted(json.loads(row['conflicts']), key=Sovoc.rev_key, reverse=True)
+            return entry
+            
+        def _pages(conn, remaining):
+            # Without a snapshot connection, each page is read in its own short transaction
+            statement, page_values, offset = get_first, values, skip
+            while remaining is None or remaining > 0:
+                size = chunk if remaining is None else min(chunk, remaining)
+                if conn:
+                    results = conn.execute(statement, page_values + [size, offset]).fetchall()
+                else:
+                    with self.conn:
+                        results = self.conn.execute(statement, page_values + [size, offset]).fetchall()
                 if not results:
                     break
+                yield [_entry(row) for row in results]
+                
+                statement, page_values, offset = get_next, values + [results[-1]['_id']], 0
+                if remaining is not None:
+                    remaining -= len(results)
                     
-                for row in results:
-                    entry = {'id': row['_id'], 'rev': row['_rev']}
-                    if include_docs:
-                        entry['doc'] = json.loads(row['body'])
-                        
-                    # If conflicts are requested, we return all leaf revisions. TODO: check format for conflicts - should they be grouped?
-                    if conflicts:
-                        yield entry
-                    elif row['_id'] != current_id: # otherwise, only the winners (the first revision)
-                        current_id = row['_id']
-
-                        yield entry
+        # The snapshot is taken now, and the Scan closes it
+        conn = self.snapshot() if kwargs.get('snapshot', False) else None
+        return Scan(_pages(conn, limit), conn)
+                    
+    def _list_keys(self, fields, keys, conflicts):
+        # Look the keys up a batch at a time to stay well inside SQLite's limit on bound
+        # parameters, and report them in the order requested.
+        for start in range(0, len(keys), KEYS_CHUNK):
+            batch = keys[start:start+KEYS_CHUNK]
+            # Live leaves sort first, so a document whose leaves are all deleted is won by a tombstone
+            get_keyed_leaves = 'SELECT {0}, d._deleted FROM documents d WHERE d.leaf=1 AND d._id IN ({1}) ORDER BY d._id, d._deleted, d.generation DESC, d._rev DESC'.format(fields, ','.join(['?']*len(batch)))
+            
+            found = {}
+            with self.conn:
+                for row in self.conn.execute(get_keyed_leaves, batch):
+                    found.setdefault(row['_id'], []).append(row)
+                
+            page = []
+            for key in batch:
+                if key not in found:
+                    page.append({'key': key, 'error': 'not_found'})
+                    continue
+                    
+                # The winner comes first; any other live leaves are its conflicts
+                winner = found[key][0]
+                entry = Sovoc._list_entry(winner)
+                if winner['_deleted']:
+                    # As in CouchDB, a deleted document is reported with its tombstone's rev
+                    entry['deleted'] = True
+                    if 'doc' in entry:
+                        entry['doc'] = None
+                elif conflicts:
+                    others = [row['_rev'] for row in found[key][1:] if not row['_deleted']]
+                    if others:
+                        entry['doc']['_conflicts'] = others
+                page.append(entry)
+                
+            yield page
+                    
+    @classmethod
+    def _list_entry(cls, row):
+        entry = {'id': row['_id'], 'key': row['_id'], 'rev': row['_rev']}
+        if 'body' in row.keys():
+            entry['doc'] = json.loads(row['body'])
+        return entry
                         
+    def define_view(self, name, map_fn, reduce=None):
+        view = View(self, name, map_fn, reduce)
+        self.views[name] = view
+        return view
+        
+    def query(self, name, **kwargs):
+        if name not in self.views:
+            raise SovocError('No such view: {}'.format(name))
+        return self.views[name].query(**kwargs)
+        
     def fetch(self, **kwargs):
         """_bulk_get"""
         pass
@@ -306,14 +845,26 @@ class Sovoc:
         cq = Mango(query)
         statement, values = cq.statement()
         
-        with self.conn:
-            c = self.conn.cursor()
-            c.execute(statement, values)
-            
-            while True:
-                results = c.fetchmany(chunk)
-                if not results:
-                    break
-                    
-                for row in results:
-                    yield {key: row[key] for key in row.keys()}
\ No newline at end of file
+        def _pages():
+            # A Mango sort has no key to resume from, so the query runs on a snapshot connection
+            # of its own. An in-memory database has no other connection to give, and its
+            # results are read in one go instead.
+            if self.database == ':memory:':
+                with self.conn:
+                    results = self.conn.execute(statement, values).fetchall()
+                for start in range(0, len(results), chunk):
+                    yield [{key: row[key] for key in row.keys()} for row in results[start:start+chunk]]
+                return
+                
+            conn = self.snapshot()
+            try:
+                c = conn.execute(statement, values)
+                while True:
+                    results = c.fetchmany(chunk)
+                    if not results:
+                        break
+                    yield [{key: row[key] for key in row.keys()} for row in results]
+            finally:
+                conn.close()
+                
+        return Scan(_pages())
@@ -0,0 +1,284 @@
+import os
+import json
+import base64
+import threading
+
+from queue import Queue
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from sovoc.sovoc import Sovoc
+from sovoc.scan import put
+from sovoc.exceptions import SovocError, ConflictError
+
+FORMATS = ['ndjson', 'alldocs']
+
+CHECKPOINTS = '''
+    CREATE TABLE IF NOT EXISTS checkpoints (
+        -- Progress of resumable imports, written in the
+        -- same transaction as each batch of documents
+      name TEXT PRIMARY KEY,
+      input_offset INTEGER NOT NULL,
+      docs INTEGER NOT NULL
+    )'''
+
+# ==============================================================================
+#  Import
+# ==============================================================================
+
+def _parse(line, fmt):
+    # Returns the documents held on one input line. CouchDB writes _all_docs
+    # responses one row per line, between a header and a footer line.
+    text = line.strip()
+    if fmt == 'ndjson':
+        return [json.loads(text)] if text else []
+
+    text = text.rstrip(b',')
+    if not text.startswith(b'{'):
+        return []
+    if text.startswith(b'{"total_rows"'):
+        try: # the whole response on a single line
+            return [row['doc'] for row in json.loads(text)['rows'] if 'doc' in row]
+        except ValueError:
+            return [] # just the header
+    row = json.loads(text)
+    return [row['doc']] if 'doc' in row else []
+
+def _prepare(lines, fmt, new_edits):
+    """
+    The parse and hash stage, run in the worker pool. Turns a batch of raw
+    lines into documents that the writer can store with new_edits=False.
+    """
+    docs = []
+    for line in lines:
+        for doc in _parse(line, fmt):
+            if new_edits:
+                # Loaded as brand new documents: any revision history in the input is dropped
+                doc.pop('_rev', None)
+                doc.pop('_revisions', None)
+                docid = doc.pop('_id', None) or Sovoc.gen_docid()
+                revid = Sovoc.gen_revid(1, dict(doc))
+                doc.update({'_id': docid, '_rev': revid})
+            docs.append(doc)
+    return docs
+
+def _check_new(conn, docs):
+    # Documents loaded as new can only be created once: an _id already held, or seen
+    # earlier in the batch, is a conflict rather than a second first revision
+    find_existing = 'SELECT DISTINCT _id FROM documents WHERE _id IN (SELECT value FROM json_each(?))'
+
+    ids = [doc['_id'] for doc in docs]
+    seen = set(row['_id'] for row in conn.execute(find_existing, [json.dumps(ids)]))
+    conflicts = []
+    for docid in ids:
+        if docid in seen:
+            conflicts.append(docid)
+        seen.add(docid)
+
+    if conflicts:
+        raise ConflictError({'error': 'conflict', 'reason': 'Document update conflict.', 'ids': conflicts})
+
+def _read_batches(stream, offset, batch_size, batches, stop):
+    # The reader stage: hands batches of raw lines to the pipeline together with
+    # the input offset just past the batch, which is what a checkpoint records.
+    try:
+        lines = []
+        for line in stream:
+            offset += len(line)
+            lines.append(line)
+            if len(lines) >= batch_size:
+                if not put(batches, (lines, offset, None), stop):
+                    return
+                lines = []
+        if lines and not put(batches, (lines, offset, None), stop):
+            return
+        put(batches, (None, offset, None), stop)
+    except Exception as e:
+        put(batches, (None, offset, e), stop)
+
+def _load_checkpoint(db, name):
+    # The database's own record is authoritative; the checkpoint file only mirrors it
+    find_checkpoint = 'SELECT input_offset, docs FROM checkpoints WHERE name=?'
+
+    with db.conn:
+        db.conn.execute(CHECKPOINTS)
+        row = db.conn.execute(find_checkpoint, [name]).fetchone()
+
+    if row:
+        return {'offset': row['input_offset'], 'docs': row['docs']}
+    return {'offset': 0, 'docs': 0}
+
+def _save_checkpoint(checkpoint, state):
+    # A copy of the database's checkpoint row, for reading progress from outside.
+    # Written aside and renamed into place, so it is never torn.
+    tmp = '{}.tmp'.format(checkpoint)
+    with open(tmp, 'w') as f:
+        json.dump(state, f)
+    os.replace(tmp, checkpoint)
+
+def import_docs(db, stream, fmt='ndjson', batch_size=10000, workers=None, new_edits=True, checkpoint=None, depth=4):
+    """
+    Load documents from a binary stream of NDJSON or a CouchDB _all_docs dump
+    (with include_docs=true) into db.
+
+    A reader thread feeds batches of lines to a process pool that parses and
+    hashes them, while the calling thread writes each batch, in input order,
+    in a single bulk() transaction. At most depth batches are in flight at
+    any time. workers=0 parses and hashes in the calling thread instead.
+
+    With new_edits=True every input document is stored as a new first
+    revision, and an _id that already exists, in db or earlier in the input,
+    raises ConflictError; the batches before it stay committed. With
+    new_edits=False the _rev and _revisions in the input are kept,
+    preserving history.
+
+    If checkpoint names a file, the input offset after each batch is recorded
+    in db, in the same transaction as the batch, and mirrored to that file. A
+    later run with the same checkpoint resumes from the recorded offset.
+    Returns the total number of documents written.
+    """
+    if fmt not in FORMATS:
+        raise SovocError('Unknown format: {}'.format(fmt))
+
+    name = os.path.abspath(checkpoint) if checkpoint else None
+    state = _load_checkpoint(db, name) if checkpoint else {'offset': 0, 'docs': 0}
+    if state['offset']:
+        if not stream.seekable():
+            raise SovocError('Cannot resume from a checkpoint on an unseekable input')
+        stream.seek(state['offset'])
+
+    batches = Queue(maxsize=depth)
+    stop = threading.Event()
+    reader = threading.Thread(target=_read_batches, args=(stream, state['offset'], batch_size, batches, stop), daemon=True)
+    reader.start()
+
+    save_checkpoint = 'INSERT OR REPLACE INTO checkpoints (name, input_offset, docs) VALUES (?, ?, ?)'
+
+    def _write(docs, offset):
+        if docs or checkpoint:
+            # The check, the checkpoint and the documents share one transaction, which
+            # bulk() commits; a batch is never written without its checkpoint, or vice versa
+            with db.conn:
+                db.conn.execute('BEGIN IMMEDIATE')
+                if new_edits and docs:
+                    _check_new(db.conn, docs)
+                if checkpoint:
+                    db.conn.execute(save_checkpoint, [name, offset, state['docs'] + len(docs)])
+                if docs:
+                    db.bulk(docs, new_edits=False)
+        state['offset'] = offset
+        state['docs'] += len(docs)
+        if checkpoint:
+            _save_checkpoint(checkpoint, state)
+
+    pool = ProcessPoolExecutor(max_workers=workers) if workers != 0 else None
+    pending = deque()
+    try:
+        while True:
+            lines, offset, error = batches.get()
+            if error:
+                raise error
+            if lines is None:
+                break
+
+            if not pool:
+                _write(_prepare(lines, fmt, new_edits), offset)
+                continue
+
+            pending.append((pool.submit(_prepare, lines, fmt, new_edits), offset))
+            if len(pending) >= depth:
+                future, offset = pending.popleft()
+                _write(future.result(), offset)
+
+        while pending:
+            future, offset = pending.popleft()
+            _write(future.result(), offset)
+    finally:
+        stop.set()
+        if pool:
+            pool.shutdown(cancel_futures=True)
+
+    return state['docs']
+
+# ==============================================================================
+#  Export
+# ==============================================================================
+
+def _snapshot(db):
+    # A read transaction, so the export sees one consistent state, and whether it
+    # was begun here. In-memory databases can only be read through their own
+    # connection, inside any transaction the caller already has open.
+    if db.database != ':memory:':
+        return db.snapshot(), True
+
+    if db.conn.in_transaction:
+        return db.conn, False
+    db.conn.execute('BEGIN')
+    return db.conn, True
+
+def _inline_attachments(conn, doc):
+    # Stubs alone can't be loaded elsewhere, so exports carry the attachment content
+    find_blob = 'SELECT data FROM blobs WHERE digest=?'
+    for (name, stub) in doc['_attachments'].items():
+        data = conn.execute(find_blob, [stub['digest']]).fetchone()['data']
+        doc['_attachments'][name] = {'content_type': stub['content_type'], 'data': base64.b64encode(data).decode('ascii')}
+
+def export_docs(db, out, fmt='ndjson', history=False, chunk=1000):
+    """
+    Write the winning revision of every live document in db to the text
+    stream out, in _id order, as NDJSON or as a CouchDB _all_docs response.
+    With history=True each document carries its _revisions, so that importing
+    it with new_edits=False reproduces the winning branch.
+    Returns the number of documents written.
+    """
+    if fmt not in FORMATS:
+        raise SovocError('Unknown format: {}'.format(fmt))
+
+    get_winners = '''
+      SELECT d.rowid, d._id, d._rev, d.generation, d.body FROM documents d
+      WHERE d.leaf=1 AND d._deleted=0
+      AND d.rowid=(SELECT rowid FROM documents WHERE _id=d._id AND leaf=1 AND _deleted=0 ORDER BY generation DESC, _rev DESC LIMIT 1)
+      ORDER BY d._id'''
+    find_ancestral_revs = 'SELECT d._rev FROM documents d JOIN ancestors a ON (d.rowid = a.ancestor) WHERE a.descendant=? ORDER BY generation DESC'
+    get_counter = 'SELECT value FROM counters WHERE name=?'
+
+    conn, began = _snapshot(db)
+    count = 0
+    try:
+        if fmt == 'alldocs':
+            total_rows = conn.execute(get_counter, ['doc_count']).fetchone()['value']
+            out.write('{{"total_rows":{0},"offset":0,"rows":[\n'.format(total_rows))
+
+        c = conn.cursor()
+        c.execute(get_winners)
+        while True:
+            results = c.fetchmany(chunk)
+            if not results:
+                break
+
+            for row in results:
+                doc = json.loads(row['body'])
+                if history:
+                    ids = [rev['_rev'].split('-', 1)[1] for rev in conn.execute(find_ancestral_revs, [row['rowid']])]
+                    doc['_revisions'] = {'start': row['generation'], 'ids': ids}
+                if '_attachments' in doc:
+                    _inline_attachments(conn, doc)
+
+                if fmt == 'ndjson':
+                    out.write(json.dumps(doc))
+                    out.write('\n')
+                else:
+                    if count:
+                        out.write(',\n')
+                    out.write(json.dumps({'id': row['_id'], 'key': row['_id'], 'value': {'rev': row['_rev']}, 'doc': doc}))
+                count += 1
+
+        if fmt == 'alldocs':
+            out.write('\n]}\n')
+    finally:
+        if began:
+            conn.rollback()
+        if conn is not db.conn:
+            conn.close()
+
+    return count
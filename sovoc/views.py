@@ -0,0 +1,398 @@
+import re
+import json
+import marshal
+import hashlib
+
+from sovoc.scan import Scan, window
+from sovoc.exceptions import SovocError
+
+REDUCERS = ['_count', '_sum', '_stats']
+
+def _type_rank(value):
+    # CouchDB collation: null < false < true < numbers < strings < arrays < objects
+    if value is None:
+        return 0
+    if value is False:
+        return 1
+    if value is True:
+        return 2
+    if isinstance(value, (int, float)):
+        return 3
+    if isinstance(value, str):
+        return 4
+    if isinstance(value, list):
+        return 5
+    return 6
+
+def _compare(a, b):
+    ra = _type_rank(a)
+    rb = _type_rank(b)
+    if ra != rb:
+        return -1 if ra < rb else 1
+
+    if ra == 5: # arrays compare element-wise, then on length
+        for (x, y) in zip(a, b):
+            result = _compare(x, y)
+            if result:
+                return result
+        return _compare(len(a), len(b))
+
+    if ra == 6: # objects compare as lists of key/value pairs
+        return _compare([list(item) for item in a.items()], [list(item) for item in b.items()])
+
+    if ra < 3:
+        return 0
+
+    return (a > b) - (a < b)
+
+def collate(a, b):
+    """SQLite collation comparing json-encoded view keys in CouchDB order"""
+    return _compare(json.loads(a), json.loads(b))
+
+def _contributions(key):
+    # The rollup rows a map key feeds into, as (level, exact, group key):
+    # the overall total, one row per proper prefix of an array key, and
+    # the exact key itself
+    yield (0, 0, None)
+    if isinstance(key, list):
+        for level in range(1, len(key)):
+            yield (level, 0, key[:level])
+        yield (len(key), 1, key)
+    else:
+        yield (1, 1, key)
+
+def _group_key(key, group_level):
+    # group_level None means group=True (exact keys)
+    if group_level is None:
+        return key
+    if group_level == 0:
+        return None
+    if isinstance(key, list):
+        return key[:group_level]
+    return key
+
+class View:
+    """
+    A map/reduce view materialized in its own tables and brought up to date
+    incrementally from the database's changes feed.
+
+    map_fn is called with each winning document and returns (or yields)
+    (key, value) pairs. reduce is None or one of the built-ins '_count',
+    '_sum' or '_stats'. Reductions are kept as per-group rollups for the
+    total, every array-key prefix and every exact key, so that reduced
+    queries read rollup rows rather than re-reducing map rows.
+    """
+    def __init__(self, db, name, map_fn, reduce=None):
+        if not re.match(r'^[A-Za-z_][A-Za-z0-9_]*$', name):
+            raise SovocError('Bad view name: {}'.format(name))
+        if reduce is not None and reduce not in REDUCERS:
+            raise SovocError('Unknown reduce function: {}'.format(reduce))
+
+        self.db = db
+        self.name = name
+        self.map_fn = map_fn
+        self.reduce = reduce
+        self.map_table = 'view_{}'.format(name)
+        self.reduce_table = 'view_{}_reduce'.format(name)
+
+        m = hashlib.md5()
+        m.update(marshal.dumps(map_fn.__code__))
+        m.update((reduce or '').encode('utf-8'))
+        self.signature = m.hexdigest()
+
+        self._setup()
+
+    def _setup(self):
+        create_map = '''
+        CREATE TABLE IF NOT EXISTS {0} (
+          docid TEXT NOT NULL,
+          key TEXT NOT NULL COLLATE couchjson,
+          value TEXT
+        )'''.format(self.map_table)
+        create_map_key_idx = 'CREATE INDEX IF NOT EXISTS {0}_key_idx ON {0} (key, docid)'.format(self.map_table)
+        create_map_docid_idx = 'CREATE INDEX IF NOT EXISTS {0}_docid_idx ON {0} (docid)'.format(self.map_table)
+        create_reduce = '''
+        CREATE TABLE IF NOT EXISTS {0} (
+          level INTEGER NOT NULL,
+          exact INTEGER NOT NULL CHECK (exact = 0 OR exact = 1),
+          key TEXT NOT NULL COLLATE couchjson,
+          count INTEGER NOT NULL,
+          sum NUMERIC,
+          sumsqr NUMERIC,
+          min NUMERIC,
+          max NUMERIC,
+          PRIMARY KEY (level, exact, key)
+        )'''.format(self.reduce_table)
+        create_reduce_key_idx = 'CREATE INDEX IF NOT EXISTS {0}_key_idx ON {0} (key)'.format(self.reduce_table)
+        find_view = 'SELECT signature FROM views WHERE name=?'
+        register_view = 'INSERT OR REPLACE INTO views (name, signature, seq) VALUES (?, ?, NULL)'
+
+        with self.db.conn:
+            c = self.db.conn.cursor()
+            for statement in [create_map, create_map_key_idx, create_map_docid_idx, create_reduce, create_reduce_key_idx]:
+                c.execute(statement)
+
+            c.execute(find_view, [self.name])
+            row = c.fetchone()
+            if not row or row['signature'] != self.signature:
+                # New or redefined view: rebuild from the start of the changes feed
+                c.execute('DELETE FROM {}'.format(self.map_table))
+                c.execute('DELETE FROM {}'.format(self.reduce_table))
+                c.execute(register_view, [self.name, self.signature])
+
+    def _emit(self, doc):
+        result = self.map_fn(doc)
+        if result is None:
+            return []
+        rows = []
+        for (key, value) in result:
+            if self.reduce in ['_sum', '_stats'] and (isinstance(value, bool) or not isinstance(value, (int, float))):
+                raise SovocError('{0} view {1} emitted a non-numeric value'.format(self.reduce, self.name))
+            rows.append((key, value))
+        return rows
+
+    def update(self):
+        """Process the changes made since the view was last brought up to date"""
+        get_seq = 'SELECT seq FROM views WHERE name=?'
+        set_seq = 'UPDATE views SET seq=? WHERE name=?'
+        get_winner = 'SELECT body FROM documents WHERE _id=? AND leaf=1 AND _deleted=0 ORDER BY generation DESC, _rev DESC LIMIT 1'
+        get_rows = 'SELECT key, value FROM {} WHERE docid=?'.format(self.map_table)
+        delete_rows = 'DELETE FROM {} WHERE docid=?'.format(self.map_table)
+        insert_row = 'INSERT INTO {} (docid, key, value) VALUES (?, ?, ?)'.format(self.map_table)
+
+        seq = self.db.conn.execute(get_seq, [self.name]).fetchone()['seq']
+
+        # Collect the documents touched since seq first; a document changed
+        # several times only needs its current winner mapped once.
+        docids = {}
+        for entry in self.db.changes(seq=seq):
+            docids[entry['id']] = True
+            seq = entry['seq']
+
+        if not docids:
+            return
+
+        deltas = {}
+
+        with self.db.conn:
+            c = self.db.conn.cursor()
+            for docid in docids:
+                if self.reduce:
+                    for row in c.execute(get_rows, [docid]).fetchall():
+                        self._accumulate(deltas, json.loads(row['key']), json.loads(row['value']), -1)
+                c.execute(delete_rows, [docid])
+
+                c.execute(get_winner, [docid])
+                winner = c.fetchone()
+                if not winner:
+                    continue
+
+                for (key, value) in self._emit(json.loads(winner['body'])):
+                    c.execute(insert_row, [docid, json.dumps(key), json.dumps(value)])
+                    if self.reduce:
+                        self._accumulate(deltas, key, value, 1)
+
+            self._apply(c, deltas)
+            c.execute(set_seq, [seq, self.name])
+
+    # ==========================================================================
+    #  Rollup maintenance
+    # ==========================================================================
+
+    def _accumulate(self, deltas, key, value, sign):
+        numeric = self.reduce in ['_sum', '_stats']
+        for (level, exact, group) in _contributions(key):
+            delta = deltas.setdefault((level, exact, json.dumps(group)), {'count': 0, 'sum': 0, 'sumsqr': 0, 'added': [], 'removed': []})
+            delta['count'] += sign
+            if numeric:
+                delta['sum'] += sign * value
+                delta['sumsqr'] += sign * value * value
+                delta['added' if sign > 0 else 'removed'].append(value)
+
+    def _apply(self, c, deltas):
+        get_rollup = 'SELECT count, sum, sumsqr, min, max FROM {} WHERE level=? AND exact=? AND key=?'.format(self.reduce_table)
+        put_rollup = 'INSERT OR REPLACE INTO {} (level, exact, key, count, sum, sumsqr, min, max) VALUES (?, ?, ?, ?, ?, ?, ?, ?)'.format(self.reduce_table)
+        delete_rollup = 'DELETE FROM {} WHERE level=? AND exact=? AND key=?'.format(self.reduce_table)
+
+        numeric = self.reduce in ['_sum', '_stats']
+
+        for ((level, exact, key), delta) in deltas.items():
+            c.execute(get_rollup, [level, exact, key])
+            row = c.fetchone()
+            count = (row['count'] if row else 0) + delta['count']
+
+            if count <= 0:
+                c.execute(delete_rollup, [level, exact, key])
+                continue
+
+            if not numeric:
+                c.execute(put_rollup, [level, exact, key, count, None, None, None, None])
+                continue
+
+            total = (row['sum'] if row else 0) + delta['sum']
+            sumsqr = (row['sumsqr'] if row else 0) + delta['sumsqr']
+            low = row['min'] if row else None
+            high = row['max'] if row else None
+
+            if low is not None and any(value <= low for value in delta['removed']) or \
+               high is not None and any(value >= high for value in delta['removed']):
+                # An extreme value went away; min/max can't be subtracted, so rescan this group only
+                low, high = self._extremes(c, level, exact, json.loads(key))
+            else:
+                values = delta['added'] + [v for v in (low, high) if v is not None]
+                low = min(values)
+                high = max(values)
+
+            c.execute(put_rollup, [level, exact, key, count, total, sumsqr, low, high])
+
+    def _extremes(self, c, level, exact, group):
+        if level == 0 and not exact:
+            statement = "SELECT MIN(json_extract(value, '$')) AS low, MAX(json_extract(value, '$')) AS high FROM {}".format(self.map_table)
+            row = c.execute(statement).fetchone()
+            return row['low'], row['high']
+
+        if exact:
+            statement = "SELECT MIN(json_extract(value, '$')) AS low, MAX(json_extract(value, '$')) AS high FROM {} WHERE key=?".format(self.map_table)
+            row = c.execute(statement, [json.dumps(group)]).fetchone()
+            return row['low'], row['high']
+
+        # Keys sharing an array prefix are contiguous in collation order, and follow the prefix itself
+        statement = 'SELECT key, value FROM {} WHERE key>? ORDER BY key'.format(self.map_table)
+        values = []
+        for row in c.execute(statement, [json.dumps(group)]).fetchall():
+            key = json.loads(row['key'])
+            if not isinstance(key, list) or key[:level] != group:
+                break
+            if len(key) > level:
+                values.append(json.loads(row['value']))
+
+        return min(values), max(values)
+
+    def _value(self, count, total, sumsqr, low, high):
+        if self.reduce == '_count':
+            return count
+        if self.reduce == '_sum':
+            return total
+        return {'sum': total, 'count': count, 'min': low, 'max': high, 'sumsqr': sumsqr}
+
+    # ==========================================================================
+    #  Queries
+    # ==========================================================================
+
+    def query(self, **kwargs):
+        """
+        See: http://docs.couchdb.org/en/2.0.0/api/ddoc/views.html#db-design-design-doc-view-view-name
+
+        Returns a Scan. Map rows are read in keyset-paged chunks on (key, docid),
+        each in a short transaction of its own.
+        """
+        self.update()
+
+        reduce = kwargs.get('reduce', True) and self.reduce is not None
+        group = kwargs.get('group', False)
+        group_level = kwargs.get('group_level', None)
+        skip = kwargs.get('skip', 0)
+        limit = kwargs.get('limit', None)
+
+        if not reduce:
+            pages = self._map_pages(None if limit is None else skip + limit, **kwargs)
+        else:
+            # Reduced rows come from the rollups, few enough to read as a single page
+            level = 0 if group_level is None and not group else None if group else group_level
+            pages = (page for page in [list(self._reduce_rows(level, **kwargs))])
+
+        return Scan(window(pages, skip, limit))
+
+    def _range(self, **kwargs):
+        descending = kwargs.get('descending', False)
+        inclusive_end = kwargs.get('inclusive_end', True)
+
+        clauses = []
+        values = []
+        if 'key' in kwargs:
+            clauses.append('key=?')
+            values.append(json.dumps(kwargs['key']))
+        else:
+            # As in CouchDB, startkey is the high end of a descending range
+            low, high = ('endkey', 'startkey') if descending else ('startkey', 'endkey')
+            if low in kwargs:
+                inclusive = inclusive_end or low == 'startkey'
+                clauses.append('key>=?' if inclusive else 'key>?')
+                values.append(json.dumps(kwargs[low]))
+            if high in kwargs:
+                inclusive = inclusive_end or high == 'startkey'
+                clauses.append('key<=?' if inclusive else 'key<?')
+                values.append(json.dumps(kwargs[high]))
+
+        return clauses, values
+
+    def _map_pages(self, remaining, **kwargs):
+        chunk = kwargs.get('chunk', 1000)
+        descending = kwargs.get('descending', False)
+        direction = 'DESC' if descending else 'ASC'
+
+        clauses, values = self._range(**kwargs)
+        statement = 'SELECT docid, key, value FROM {0} WHERE {1} ORDER BY key {2}, docid {2} LIMIT ?'
+        get_first = statement.format(self.map_table, ' AND '.join(clauses) or '1', direction)
+        # Later pages resume after the last (key, docid) seen
+        get_next = statement.format(self.map_table, ' AND '.join(clauses + ['(key, docid) {} (?, ?)'.format('<' if descending else '>')]), direction)
+
+        page_statement, page_values = get_first, values
+        while remaining is None or remaining > 0:
+            size = chunk if remaining is None else min(chunk, remaining)
+            with self.db.conn:
+                results = self.db.conn.execute(page_statement, page_values + [size]).fetchall()
+            if not results:
+                break
+            yield [{'id': row['docid'], 'key': json.loads(row['key']), 'value': json.loads(row['value'])} for row in results]
+
+            page_statement, page_values = get_next, values + [results[-1]['key'], results[-1]['docid']]
+            if remaining is not None:
+                remaining -= len(results)
+
+    def _reduce_rows(self, level, **kwargs):
+        descending = kwargs.get('descending', False)
+        direction = 'DESC' if descending else 'ASC'
+
+        fields = 'key, count, sum, sumsqr, min, max'
+        if 'startkey' in kwargs or 'endkey' in kwargs:
+            # A key range can cut through groups, but never through an exact key, so the
+            # exact rollups inside it add up to the range with no map rows read
+            clauses, values = self._range(**kwargs)
+            statement = 'SELECT {0} FROM {1} WHERE exact=1 AND {2} ORDER BY key {3}'.format(fields, self.reduce_table, ' AND '.join(clauses), direction)
+        elif 'key' in kwargs:
+            statement = 'SELECT {0} FROM {1} WHERE exact=1 AND key=?'.format(fields, self.reduce_table)
+            values = [json.dumps(kwargs['key'])]
+        elif level == 0:
+            statement = 'SELECT {0} FROM {1} WHERE level=0 AND exact=0'.format(fields, self.reduce_table)
+            values = []
+        elif level is None:
+            statement = 'SELECT {0} FROM {1} WHERE exact=1 ORDER BY key {2}'.format(fields, self.reduce_table, direction)
+            values = []
+        else:
+            # Arrays longer than group_level are covered by their prefix rollup; shorter keys by their exact rollup
+            statement = 'SELECT {0} FROM {1} WHERE (exact=0 AND level=?) OR (exact=1 AND level<=?) ORDER BY key {2}'.format(fields, self.reduce_table, direction)
+            values = [level, level]
+
+        current = None
+        for row in self.db.conn.execute(statement, values).fetchall():
+            key = _group_key(json.loads(row['key']), level)
+            if current and current[0] == key:
+                acc = current[1]
+                acc['count'] += row['count']
+                if acc['sum'] is not None:
+                    acc['sum'] += row['sum']
+                    acc['sumsqr'] += row['sumsqr']
+                    acc['min'] = min(acc['min'], row['min'])
+                    acc['max'] = max(acc['max'], row['max'])
+                continue
+
+            if current:
+                yield self._reduced(*current)
+            current = (key, {name: row[name] for name in ['count', 'sum', 'sumsqr', 'min', 'max']})
+
+        if current:
+            yield self._reduced(*current)
+
+    def _reduced(self, key, acc):
+        return {'key': key, 'value': self._value(acc['count'], acc['sum'], acc['sumsqr'], acc['min'], acc['max'])}
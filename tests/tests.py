@@ -1,8 +1,10 @@
 #!/usr/bin/env python
 
+import io
 import os
 import sys
 import json
+import base64
 
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
@@ -113,6 +115,48 @@ class TestBasics(unittest.TestCase):
             
         self.assertTrue(j == i - 3) # total - remainder - "fence post" @ 2
         
+    def test_changes_resume_in_bulk(self):
+        self.db.bulk([{'n': i} for i in range(10)])
+        feed = list(self.db.changes())
+        
+        rest = list(self.db.changes(seq=feed[2]['seq']))
+        self.assertEqual([entry['id'] for entry in rest], [entry['id'] for entry in feed[3:]])
+        
+        with self.assertRaises(SovocError):
+            list(self.db.changes(seq='not-a-seq'))
+        
+    def test_changes_filtered(self):
+        bulk_results = self.db.bulk([
+            {'name': 'adam', 'age': 31},
+            {'name': 'bob', 'age': 52},
+            {'name': 'charlie', 'age': 17}
+        ])
+        adam = bulk_results[0]
+        self.db.update({'name': 'adam', 'age': 32}, _id=adam['id'], _rev=adam['rev'])
+        
+        ids = [entry['id'] for entry in self.db.changes(filter='_doc_ids', doc_ids=[adam['id'], bulk_results[2]['id']])]
+        self.assertEqual(ids, [adam['id'], bulk_results[2]['id'], adam['id']])
+        
+        entries = list(self.db.changes(filter='_selector', selector={'age': {'$gt': 30}}, include_docs=True))
+        self.assertEqual([entry['doc']['age'] for entry in entries], [31, 52, 32])
+        
+        # Only the latest change per document
+        entries = list(self.db.changes(dedupe=True))
+        self.assertEqual(len(entries), 3)
+        self.assertEqual(entries[-1]['id'], adam['id'])
+        
+        with self.assertRaises(SovocError):
+            list(self.db.changes(filter='_design'))
+            
+    def test_changes_all_docs(self):
+        result1 = self.db.insert({'name':'stefan'})
+        result2 = self.db.insert({'name':'stefan astrup'}, _id=result1['id'], _rev=result1['rev'])
+        result3 = self.db.insert({'name':'stef'}, _id=result1['id'], _rev=result1['rev'])
+        
+        entries = list(self.db.changes(style='all_docs', dedupe=True))
+        self.assertEqual(len(entries), 1)
+        self.assertEqual(sorted(change['rev'] for change in entries[0]['changes']), sorted([result2['rev'], result3['rev']]))
+        
     def test_alldocs1(self):
         result1 = self.db.insert({'name':'stefan'}) 
         result2 = self.db.insert({'name':'stefan astrup'}, _id=result1['id'], _rev=result1['rev'])
@@ -136,10 +180,15 @@ class TestBasics(unittest.TestCase):
         self.assertEqual(count, 7)
             
         count = 0
-        for leaf in self.db.list(include_docs=True, conflicts=True):
+        for winner in self.db.list(include_docs=True, conflicts=True):
             count += 1
+            if winner['id'] == result1['id']:
+                self.assertEqual(winner['rev'], result5['rev'])
+                self.assertEqual(sorted(winner['doc']['_conflicts']), sorted([result3['rev'], result4['rev']]))
+            else:
+                self.assertNotIn('_conflicts', winner['doc'])
             
-        self.assertEqual(count, 9)
+        self.assertEqual(count, 7)
         
         keys = [result1['id'], bulk_results[2]['id'], bulk_results[5]['id']]
         count = 0
@@ -148,5 +197,147 @@ class TestBasics(unittest.TestCase):
             
         self.assertEqual(count, len(keys))
         
+    def test_info(self):
+        info = self.db.info()
+        self.assertEqual(info['doc_count'], 0)
+        self.assertIsNone(info['update_seq'])
+        
+        result1 = self.db.insert({'name':'stefan'})
+        result2 = self.db.insert({'name':'stefan astrup'}, _id=result1['id'], _rev=result1['rev'])
+        result3 = self.db.insert({'name':'stef'}, _id=result1['id'], _rev=result1['rev'])
+        result4 = self.db.insert({'name':'bob'})
+        result5 = self.db.destroy(result4['id'], result4['rev'])
+        
+        info = self.db.info()
+        self.assertEqual(info['doc_count'], 1)
+        self.assertEqual(info['doc_del_count'], 1)
+        self.assertEqual(info['doc_conflict_count'], 1)
+        self.assertEqual(info['rev_count'], 5)
+        
+        size = self.db.conn.execute('SELECT SUM(LENGTH(CAST(body AS BLOB))) AS size FROM documents').fetchone()['size']
+        self.assertEqual(info['data_size'], size)
+        self.assertEqual(info['update_seq'], list(self.db.changes())[-1]['seq'])
+        
+        # Resolving the conflict takes the document out of the index
+        self.db.destroy(result1['id'], result3['rev'])
+        info = self.db.info()
+        self.assertEqual(info['doc_count'], 1)
+        self.assertEqual(info['doc_conflict_count'], 0)
+        self.assertEqual(list(self.db.conflicts()), [])
+        
+    def test_conflicts(self):
+        result1 = self.db.insert({'name':'stefan'}, _id='a')
+        result2 = self.db.insert({'name':'stefan astrup'}, _id='a', _rev=result1['rev'])
+        result3 = self.db.insert({'name':'stef'}, _id='a', _rev=result1['rev'])
+        result4 = self.db.insert({'name':'bob'}, _id='b')
+        result5 = self.db.insert({'name':'charlie'}, _id='c')
+        result6 = self.db.insert({'name':'charles'}, _id='c', _rev=result5['rev'])
+        result7 = self.db.insert({'name':'chuck'}, _id='c', _rev=result5['rev'])
+        
+        found = list(self.db.conflicts())
+        self.assertEqual([doc['_id'] for doc in found], ['a', 'c'])
+        winner, loser = sorted([result2['rev'], result3['rev']], reverse=True)
+        self.assertEqual(found[0], {'_id': 'a', '_rev': winner, '_conflicts': [loser]})
+        
+        found = list(self.db.conflicts(startkey='b', limit=1))
+        self.assertEqual([doc['_id'] for doc in found], ['c'])
+        
+        rows = list(self.db.list(keys=['a', 'b'], include_docs=True, conflicts=True))
+        self.assertEqual(rows[0]['doc']['_conflicts'], [loser])
+        self.assertNotIn('_conflicts', rows[1]['doc'])
+        
+    def test_alldocs_paging(self):
+        self.db.bulk([{'_id': 'doc{0:03d}'.format(i)} for i in range(100)])
+        result = self.db.insert({'_id': 'gone'})
+        self.db.destroy(result['id'], result['rev'])
+        
+        self.assertEqual(self.db.total_rows(), 100)
+        
+        # Keyset paging: restart each page from the last id seen
+        seen = []
+        startkey = None
+        while True:
+            if startkey:
+                page = list(self.db.list(startkey=startkey, skip=1, limit=30))
+            else:
+                page = list(self.db.list(limit=30))
+            if not page:
+                break
+            seen.extend(entry['id'] for entry in page)
+            startkey = page[-1]['id']
+            
+        self.assertEqual(seen, ['doc{0:03d}'.format(i) for i in range(100)])
+        
+        ids = [entry['id'] for entry in self.db.list(startkey='doc010', endkey='doc013', inclusive_end=False)]
+        self.assertEqual(ids, ['doc010', 'doc011', 'doc012'])
+        
+        ids = [entry['id'] for entry in self.db.list(startkey='doc013', endkey='doc010', descending=True)]
+        self.assertEqual(ids, ['doc013', 'doc012', 'doc011', 'doc010'])
+        
+    def test_alldocs_many_keys(self):
+        self.db.bulk([{'_id': 'doc{0:04d}'.format(i)} for i in range(1200)])
+        
+        keys = ['doc{0:04d}'.format(i) for i in reversed(range(1200))] + ['missing']
+        rows = list(self.db.list(keys=keys))
+        
+        self.assertEqual([row['key'] for row in rows], keys)
+        self.assertEqual(rows[-1], {'key': 'missing', 'error': 'not_found'})
+        
+        rows = list(self.db.list(keys=keys, skip=10, limit=5))
+        self.assertEqual([row['key'] for row in rows], keys[10:15])
+        
+    def test_alldocs_keys_deleted(self):
+        result = self.db.insert({'name': 'bob'}, _id='bob')
+        tombstone = self.db.destroy('bob', result['rev'])
+        
+        rows = list(self.db.list(keys=['bob', 'missing'], include_docs=True))
+        self.assertEqual(rows[0], {'id': 'bob', 'key': 'bob', 'rev': tombstone['rev'], 'deleted': True, 'doc': None})
+        self.assertEqual(rows[1], {'key': 'missing', 'error': 'not_found'})
+        
+        # Deleted documents are still left out of a range listing
+        self.assertEqual(list(self.db.list()), [])
+        
+    def test_attachment_inline(self):
+        data = base64.b64encode(b'hello, world').decode('ascii')
+        result = self.db.insert({'name': 'stefan', '_attachments': {'greeting.txt': {'content_type': 'text/plain', 'data': data}}})
+        
+        doc = self.db.get(result['id'])
+        stub = doc['_attachments']['greeting.txt']
+        self.assertTrue(stub['stub'])
+        self.assertEqual(stub['length'], 12)
+        self.assertNotIn('data', stub)
+        
+        self.assertEqual(b''.join(self.db.attachment(result['id'], 'greeting.txt')), b'hello, world')
+        
+    def test_attachment_stream(self):
+        payload = os.urandom(100000)
+        result1 = self.db.insert({'name': 'stefan'})
+        result2 = self.db.put_attachment(result1['id'], result1['rev'], 'random.bin', io.BytesIO(payload), chunk=4096)
+        
+        chunks = list(self.db.attachment(result2['id'], 'random.bin', chunk=4096))
+        self.assertEqual(len(chunks), 25)
+        self.assertEqual(b''.join(chunks), payload)
+        
+        # Updating the document with the stub shares the stored content
+        doc = self.db.get(result2['id'])
+        doc['name'] = 'stefan astrup'
+        result3 = self.db.update(doc)
+        self.assertEqual(self.db.get(result3['id'])['_attachments']['random.bin']['revpos'], 2)
+        
+        # ...as does attaching the same content to another document
+        self.db.put_attachment(None, None, 'copy.bin', payload)
+        count = self.db.conn.execute('SELECT COUNT(*) AS n FROM blobs').fetchone()['n']
+        self.assertEqual(count, 1)
+        
+    def test_attachment_missing_stub(self):
+        with self.assertRaises(SovocError):
+            self.db.insert({'_attachments': {'nothing.txt': {'stub': True, 'digest': 'md5-bogus'}}})
+        with self.assertRaises(SovocError):
+            self.db.insert({'_attachments': {'nothing.txt': {'content_type': 'text/plain'}}})
+            
+        result = self.db.insert({'name': 'bob'})
+        with self.assertRaises(SovocError):
+            self.db.attachment(result['id'], 'nothing.txt')
+        
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import json
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+from sovoc.sovoc import Sovoc
+from sovoc.exceptions import SovocError
+
+class TestScan(unittest.TestCase):
+    db = None
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.database = os.path.join(self.tmpdir, 'scan.db')
+        self.db = Sovoc(self.database)
+        self.db.setup()
+        self.db.bulk([{'_id': 'doc{0:03d}'.format(i), 'n': i} for i in range(100)])
+
+    def tearDown(self):
+        self.db.conn.close()
+        self.db = None
+        shutil.rmtree(self.tmpdir)
+
+    def test_no_transaction_between_chunks(self):
+        for scan in [self.db.changes(chunk=10), self.db.list(chunk=10), self.db.conflicts(chunk=10)]:
+            with scan:
+                next(scan, None)
+                self.assertFalse(self.db.conn.in_transaction)
+
+        # Another writer can commit while a scan is part-way through
+        scan = self.db.list(chunk=10)
+        next(scan)
+        other = Sovoc(self.database, timeout=0)
+        other.insert({'name': 'stefan'}, _id='zzz')
+        other.conn.close()
+        self.assertEqual(len(list(scan)), 100) # 99 left, plus the new document at the end of the range
+        scan.close()
+
+    def test_changes_snapshot(self):
+        scan = self.db.changes(chunk=10)
+        first = [next(scan) for _ in range(5)]
+        self.db.bulk([{'_id': 'new{0:03d}'.format(i)} for i in range(10)])
+
+        # Changes made after the feed was opened are left for the next read of the feed
+        rest = list(scan)
+        self.assertEqual(len(first) + len(rest), 100)
+        self.assertEqual(len(list(self.db.changes(seq=rest[-1]['seq']))), 10)
+
+    def test_list_snapshot(self):
+        scan = self.db.list(chunk=10, snapshot=True)
+        next(scan)
+        self.db.bulk([{'_id': 'new{0:03d}'.format(i)} for i in range(10)])
+
+        self.assertEqual(len(list(scan)), 99)
+        self.assertEqual(len(list(self.db.list())), 110)
+
+    def test_close_unread_snapshot(self):
+        scan = self.db.list(snapshot=True)
+        scan.close()
+        with self.assertRaises(sqlite3.ProgrammingError):
+            scan.conn.execute('SELECT 1')
+
+        # Nothing pins the WAL, so a checkpoint can complete
+        self.db.insert({'name': 'stefan'})
+        row = self.db.conn.execute('PRAGMA wal_checkpoint(TRUNCATE)').fetchone()
+        self.assertEqual(row[0], 0)
+
+    def test_find_snapshot(self):
+        query = {
+            'selector': {
+                'n': {
+                    '$gte': 50
+                }
+            },
+            'fields': ['_id', 'n'],
+            'sort': [{'n': 'asc'}]
+        }
+
+        scan = self.db.find(query, chunk=10)
+        self.assertEqual(next(scan)['n'], 50)
+        self.db.insert({'n': 1000})
+
+        self.assertEqual(len(list(scan)), 49)
+
+    def test_close(self):
+        scan = self.db.list(chunk=10, skip=5, limit=20)
+        self.assertEqual(next(scan)['id'], 'doc005')
+        scan.close()
+        self.assertEqual(list(scan), [])
+
+        with self.db.find({'selector': {}, 'fields': ['_id']}, chunk=10) as scan:
+            next(scan)
+        self.assertTrue(scan.closed)
+
+    def test_memory_snapshot(self):
+        db = Sovoc(':memory:')
+        with self.assertRaises(SovocError):
+            db.snapshot()
+        db.conn.close()
+
+if __name__ == '__main__':
+    unittest.main()
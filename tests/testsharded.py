@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import json
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import unittest
+import uuid
+import sqlite3
+import threading
+import time
+
+from sovoc.sharded import ShardedSovoc
+from sovoc.exceptions import SovocError, ConflictError
+
+class TestSharded(unittest.TestCase):
+    database = ':memory:'
+    db = None
+
+    def setUp(self):
+        self.db = ShardedSovoc(self.database, q=4)
+        self.db.setup()
+
+    def tearDown(self):
+        self.db.close()
+        self.db = None
+
+    def test_routing(self):
+        result = self.db.insert({'name':'stefan'})
+        self.assertTrue(result['ok'])
+
+        shard = self.db.shard(result['id'])
+        self.assertEqual(shard.get(result['id'])['_rev'], result['rev'])
+        self.assertEqual(self.db.get(result['id'])['_rev'], result['rev'])
+
+        result2 = self.db.update({'name':'stefan astrup'}, _id=result['id'], _rev=result['rev'])
+        data = self.db.open_revs(result['id'])
+        self.assertEqual(len(data), 1)
+        self.assertEqual(data[0]['ok']['_rev'], result2['rev'])
+
+    def test_bulk_preserves_order(self):
+        docs = [{'_id': 'doc{0:03d}'.format(i), 'n': i} for i in range(50)]
+        result = self.db.bulk(docs)
+
+        self.assertEqual([entry['id'] for entry in result], [doc['_id'] for doc in docs])
+        # ...and the documents really were spread over several shards
+        self.assertTrue(len(set(self.db.shard_index(doc['_id']) for doc in docs)) > 1)
+
+    def test_bulk_conflict(self):
+        result = self.db.insert({'name':'bob'})
+        with self.assertRaises(ConflictError):
+            self.db.bulk([{'_id': result['id'], '_rev': 'a bad rev'}])
+
+        # Shards commit independently; the error says which documents made it
+        docs = [{'_id': 'doc{0:03d}'.format(i)} for i in range(20)] + [{'_id': result['id'], '_rev': 'a bad rev'}]
+        with self.assertRaises(ConflictError) as caught:
+            self.db.bulk(docs)
+
+        failed = self.db.shard_index(result['id'])
+        entries = caught.exception.results
+        self.assertEqual([entry['id'] for entry in entries], [doc['_id'] for doc in docs])
+        for entry in entries:
+            if self.db.shard_index(entry['id']) == failed:
+                self.assertEqual(entry['error'], 'conflict')
+            else:
+                self.assertTrue(entry['ok'])
+                self.assertEqual(self.db.get(entry['id'])['_rev'], entry['rev'])
+        self.assertEqual(self.db.total_rows(), 1 + sum(1 for entry in entries if 'ok' in entry))
+
+    def test_list_merged(self):
+        self.db.bulk([{'_id': 'doc{0:03d}'.format(i)} for i in range(50)])
+
+        ids = [entry['id'] for entry in self.db.list()]
+        self.assertEqual(ids, sorted(ids))
+        self.assertEqual(len(ids), 50)
+
+        ids = [entry['id'] for entry in self.db.list(startkey='doc040', descending=True, skip=1, limit=3)]
+        self.assertEqual(ids, ['doc039', 'doc038', 'doc037'])
+        self.assertEqual(self.db.total_rows(), 50)
+
+        keys = ['doc007', 'doc042', 'missing', 'doc013']
+        rows = list(self.db.list(keys=keys, include_docs=True))
+        self.assertEqual([row['key'] for row in rows], keys)
+        self.assertEqual(rows[2]['error'], 'not_found')
+
+        # Repeated keys come back once per request, as from a single database
+        keys = ['doc007', 'doc007', 'doc042']
+        self.assertEqual([row['key'] for row in self.db.list(keys=keys)], keys)
+
+    def test_bulk_during_scan(self):
+        self.db.bulk([{'_id': 'doc{0:04d}'.format(i)} for i in range(2000)])
+
+        # All on one shard, so the conflict rolls back the whole of this bulk()
+        shard = self.db.shard_index('doc0000')
+        ids = [docid for docid in ('new{0:05d}'.format(i) for i in range(40000)) if self.db.shard_index(docid) == shard]
+        bad = [{'_id': docid} for docid in ids] + [{'_id': 'doc0000', '_rev': 'a bad rev'}]
+
+        # Scans reading their pages while bulk() writes must not commit the failed bulk's rows
+        def _scan():
+            for _ in range(5):
+                list(self.db.list(chunk=5))
+        reader = threading.Thread(target=_scan)
+        reader.start()
+        with self.assertRaises(ConflictError):
+            self.db.bulk(bad)
+        reader.join()
+
+        self.assertEqual(self.db.total_rows(), 2000)
+        self.assertEqual(len(list(self.db.list())), 2000)
+
+    def test_info_and_conflicts(self):
+        results = self.db.bulk([{'_id': 'doc{0:03d}'.format(i)} for i in range(20)])
+        for result in results[:3]:
+            self.db.update({'name': 'left'}, _id=result['id'], _rev=result['rev'])
+            self.db.update({'name': 'right'}, _id=result['id'], _rev=result['rev'])
+
+        info = self.db.info()
+        self.assertEqual(info['doc_count'], 20)
+        self.assertEqual(info['doc_conflict_count'], 3)
+        self.assertEqual(info['rev_count'], 26)
+        self.assertEqual(list(self.db.changes(seq=info['update_seq'])), [])
+
+        found = [doc['_id'] for doc in self.db.conflicts(limit=2)]
+        self.assertEqual(found, ['doc000', 'doc001'])
+
+    def test_changes_resume(self):
+        self.db.bulk([{'_id': 'doc{0:03d}'.format(i)} for i in range(20)])
+
+        bookmark = None
+        for entry in self.db.changes():
+            bookmark = entry['seq']
+
+        self.assertEqual(list(self.db.changes(seq=bookmark)), [])
+
+        self.db.bulk([{'_id': 'new{0:03d}'.format(i)} for i in range(5)])
+        fresh = set(entry['id'] for entry in self.db.changes(seq=bookmark))
+        self.assertEqual(fresh, set('new{0:03d}'.format(i) for i in range(5)))
+
+    def test_changes_resume_in_bulk(self):
+        self.db.bulk([{'_id': 'doc{0:03d}'.format(i)} for i in range(10)])
+        feed = list(self.db.changes())
+
+        # The first entry's token resumes every shard, including the one it came from
+        rest = set(entry['id'] for entry in self.db.changes(seq=feed[0]['seq']))
+        self.assertEqual(rest, set(entry['id'] for entry in feed[1:]))
+
+    def test_scan_close(self):
+        self.db.bulk([{'_id': 'doc{0:03d}'.format(i)} for i in range(50)])
+        threads = threading.active_count()
+
+        with self.db.list(chunk=5) as scan:
+            self.assertEqual(next(scan)['id'], 'doc000')
+        self.assertTrue(scan.closed)
+
+        scan = self.db.changes(chunk=5)
+        next(scan)
+        scan.close()
+        self.assertEqual(list(scan), [])
+
+        # The shards' threads notice and wind down
+        for _ in range(100):
+            if threading.active_count() == threads:
+                break
+            time.sleep(0.02)
+        self.assertEqual(threading.active_count(), threads)
+
+    def test_bad_seq(self):
+        with self.assertRaises(SovocError):
+            list(self.db.changes(seq='2-bm90IGEgdG9rZW4='))
+        with self.assertRaises(SovocError):
+            list(self.db.changes(seq='abc-WyIxIiwgIjIiLCAiMyIsICI0Il0='))
+
+    def test_find_sorted(self):
+        years = [1947, 1876, 2010, 2011, 1969, 2007, 1982, 2001]
+        self.db.bulk([{'year': year, 'title': str(year)} for year in years])
+
+        query = {
+            'selector': {
+                'year': {
+                    '$gt': 1900
+                }
+            },
+            'fields': ['_id', 'year'],
+            'sort': [{'year': 'desc'}]
+        }
+
+        found = [row['year'] for row in self.db.find(query)]
+        self.assertEqual(found, sorted([year for year in years if year > 1900], reverse=True))
+
+if __name__ == '__main__':
+    unittest.main()
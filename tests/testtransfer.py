@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import json
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import io
+import shutil
+import tempfile
+import unittest
+
+from sovoc.sovoc import Sovoc
+from sovoc import transfer
+from sovoc.transfer import import_docs, export_docs
+from sovoc.exceptions import SovocError, ConflictError
+from sovoc.__main__ import main
+
+class TestTransfer(unittest.TestCase):
+    database = ':memory:'
+    db = None
+
+    def setUp(self):
+        self.db = Sovoc(self.database)
+        self.db.setup()
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        self.db.conn.close()
+        self.db = None
+        shutil.rmtree(self.tmpdir)
+
+    def ndjson(self, docs):
+        return io.BytesIO(''.join(json.dumps(doc) + '\n' for doc in docs).encode('utf-8'))
+
+    def test_import_ndjson(self):
+        docs = [{'_id': 'doc{0:03d}'.format(i), 'n': i} for i in range(250)] + [{'n': 250}]
+
+        count = import_docs(self.db, self.ndjson(docs), batch_size=40, workers=2)
+
+        self.assertEqual(count, 251)
+        self.assertEqual(self.db.total_rows(), 251)
+        self.assertEqual(self.db.get('doc042')['n'], 42)
+        self.assertTrue(self.db.get('doc042')['_rev'].startswith('1-'))
+
+    def test_import_existing(self):
+        import_docs(self.db, self.ndjson([{'_id': 'x'}]), workers=0)
+
+        with self.assertRaises(ConflictError):
+            import_docs(self.db, self.ndjson([{'_id': 'y'}, {'_id': 'x', 'n': 1}]), workers=0)
+        with self.assertRaises(ConflictError):
+            import_docs(self.db, self.ndjson([{'_id': 'z'}, {'_id': 'z'}]), workers=0)
+
+        # Nothing from the rejected batches was written
+        info = self.db.info()
+        self.assertEqual(info['doc_count'], 1)
+        self.assertEqual(info['doc_conflict_count'], 0)
+
+    def test_import_history(self):
+        first = self.db.insert({'name': 'stefan'}, _id='stefan')
+        second = self.db.update({'name': 'stefan astrup'}, _id='stefan', _rev=first['rev'])
+        third = self.db.update({'name': 'stefan astrup kruger'}, _id='stefan', _rev=second['rev'])
+
+        out = io.StringIO()
+        self.assertEqual(export_docs(self.db, out, history=True), 1)
+
+        other = Sovoc(':memory:')
+        other.setup()
+        import_docs(other, io.BytesIO(out.getvalue().encode('utf-8')), workers=0, new_edits=False)
+
+        data = other.open_revs('stefan')
+        self.assertEqual(len(data), 1)
+        self.assertEqual(data[0]['ok']['_rev'], third['rev'])
+        self.assertEqual(len(data[0]['ok']['_revisions']['ids']), 3)
+
+        # The imported branch can be extended as usual
+        fourth = other.update({'name': 'stef'}, _id='stefan', _rev=third['rev'])
+        self.assertTrue(fourth['rev'].startswith('4-'))
+        other.conn.close()
+
+    def test_alldocs_round_trip(self):
+        self.db.bulk([{'_id': 'doc{0:03d}'.format(i), 'n': i} for i in range(30)])
+
+        out = io.StringIO()
+        export_docs(self.db, out, fmt='alldocs')
+        dump = json.loads(out.getvalue())
+        self.assertEqual(dump['total_rows'], 30)
+
+        other = Sovoc(':memory:')
+        other.setup()
+        count = import_docs(other, io.BytesIO(out.getvalue().encode('utf-8')), fmt='alldocs', workers=0, new_edits=False)
+        self.assertEqual(count, 30)
+        self.assertEqual([entry['rev'] for entry in other.list()], [entry['rev'] for entry in self.db.list()])
+        other.conn.close()
+
+    def test_export_in_transaction(self):
+        self.db.conn.execute('BEGIN')
+        self.db.conn.execute('INSERT INTO views (name, signature) VALUES (?, ?)', ['pending', 'x'])
+
+        export_docs(self.db, io.StringIO())
+
+        # The caller's transaction is left open, and its writes in place
+        self.assertTrue(self.db.conn.in_transaction)
+        self.db.conn.commit()
+        self.assertIsNotNone(self.db.conn.execute('SELECT 1 FROM views WHERE name=?', ['pending']).fetchone())
+
+    def test_checkpoint_resume(self):
+        path = os.path.join(self.tmpdir, 'input.ndjson')
+        checkpoint = os.path.join(self.tmpdir, 'input.checkpoint')
+        with open(path, 'w') as f:
+            for i in range(10):
+                f.write(json.dumps({'_id': 'doc{0:03d}'.format(i)}) + '\n')
+
+        with open(path, 'rb') as stream:
+            import_docs(self.db, stream, batch_size=4, workers=0, checkpoint=checkpoint)
+
+        with open(path, 'a') as f:
+            for i in range(10, 15):
+                f.write(json.dumps({'_id': 'doc{0:03d}'.format(i)}) + '\n')
+
+        # Only the lines after the checkpoint are loaded again
+        with open(path, 'rb') as stream:
+            count = import_docs(self.db, stream, batch_size=4, workers=0, checkpoint=checkpoint)
+
+        self.assertEqual(count, 15)
+        self.assertEqual(sum(1 for _ in self.db.changes()), 15)
+
+    def test_checkpoint_crash(self):
+        path = os.path.join(self.tmpdir, 'input.ndjson')
+        checkpoint = os.path.join(self.tmpdir, 'input.checkpoint')
+        with open(path, 'w') as f:
+            for i in range(8):
+                f.write(json.dumps({'_id': 'doc{0:03d}'.format(i)} if i % 2 else {'n': i}) + '\n')
+
+        # Crash after the second batch commits, before the checkpoint file catches up
+        save = transfer._save_checkpoint
+        saved = []
+        def _crash(checkpoint, state):
+            if saved:
+                raise KeyboardInterrupt
+            saved.append(dict(state))
+            save(checkpoint, state)
+
+        transfer._save_checkpoint = _crash
+        try:
+            with open(path, 'rb') as stream:
+                with self.assertRaises(KeyboardInterrupt):
+                    import_docs(self.db, stream, batch_size=3, workers=0, checkpoint=checkpoint)
+        finally:
+            transfer._save_checkpoint = save
+
+        # The rerun resumes after the committed batch: nothing is loaded twice, nor rejected
+        with open(path, 'rb') as stream:
+            count = import_docs(self.db, stream, batch_size=3, workers=0, checkpoint=checkpoint)
+
+        self.assertEqual(count, 8)
+        self.assertEqual(self.db.total_rows(), 8)
+        with open(checkpoint) as f:
+            self.assertEqual(json.load(f)['docs'], 8)
+
+    def test_cli(self):
+        source = os.path.join(self.tmpdir, 'source.ndjson')
+        database = os.path.join(self.tmpdir, 'cli.db')
+        target = os.path.join(self.tmpdir, 'target.ndjson')
+        with open(source, 'w') as f:
+            for i in range(20):
+                f.write(json.dumps({'_id': 'doc{0:03d}'.format(i), 'n': i}) + '\n')
+
+        main(['import', database, source, '--batch-size', '7', '--workers', '0'])
+        main(['export', database, target])
+
+        with open(target) as f:
+            exported = [json.loads(line) for line in f]
+        self.assertEqual([doc['n'] for doc in exported], list(range(20)))
+
+    def test_bad_format(self):
+        with self.assertRaises(SovocError):
+            import_docs(self.db, self.ndjson([]), fmt='csv')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import json
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import unittest
+import uuid
+import sqlite3
+
+from sovoc.sovoc import Sovoc
+from sovoc.exceptions import SovocError, ConflictError
+
+def by_year(doc):
+    yield doc['year'], doc['rating']
+
+def by_decade(doc):
+    yield [doc['year'] // 10 * 10, doc['year']], doc['rating']
+
+class TestViews(unittest.TestCase):
+    database = ':memory:'
+    db = None
+
+    def setUp(self):
+        self.db = Sovoc(self.database)
+        self.db.setup()
+        self.results = self.db.bulk([
+            {'year': 1947, 'rating': 10},
+            {'year': 1876, 'rating': 9},
+            {'year': 2010, 'rating': 8},
+            {'year': 2011, 'rating': 7},
+            {'year': 2010, 'rating': 6},
+            {'year': 1969, 'rating': 5},
+            {'year': 2007, 'rating': 4},
+            {'year': 1982, 'rating': 3}
+        ])
+
+    def tearDown(self):
+        self.db.conn.close()
+        self.db = None
+
+    def test_map(self):
+        self.db.define_view('by_year', by_year)
+
+        rows = list(self.db.query('by_year'))
+        self.assertEqual([row['key'] for row in rows], [1876, 1947, 1969, 1982, 2007, 2010, 2010, 2011])
+
+        rows = list(self.db.query('by_year', key=2010))
+        self.assertEqual(sorted(row['value'] for row in rows), [6, 8])
+
+        rows = list(self.db.query('by_year', startkey=1960, endkey=2007, inclusive_end=False))
+        self.assertEqual([row['key'] for row in rows], [1969, 1982])
+
+        rows = list(self.db.query('by_year', startkey=2007, endkey=1960, descending=True, limit=2))
+        self.assertEqual([row['key'] for row in rows], [2007, 1982])
+
+    def test_map_pages(self):
+        self.db.define_view('by_year', by_year)
+        rows = list(self.db.query('by_year'))
+
+        # Paged on (key, docid), so rows sharing a key are neither lost nor repeated
+        self.assertEqual(list(self.db.query('by_year', chunk=1)), rows)
+        self.assertEqual(list(self.db.query('by_year', chunk=3, descending=True)), rows[::-1])
+        self.assertEqual(list(self.db.query('by_year', chunk=2, skip=5, limit=2)), rows[5:7])
+
+        with self.db.query('by_year', chunk=2) as scan:
+            next(scan)
+            self.assertFalse(self.db.conn.in_transaction)
+        self.assertEqual(list(scan), [])
+
+    def test_incremental(self):
+        self.db.define_view('by_year', by_year, '_stats')
+        stats = list(self.db.query('by_year'))[0]['value']
+        self.assertEqual(stats['count'], 8)
+        self.assertEqual(stats['max'], 10)
+
+        # Update the highest-rated document; only that change is processed
+        first = self.results[0]
+        self.db.update({'year': 1947, 'rating': 2}, _id=first['id'], _rev=first['rev'])
+        self.db.insert({'year': 2015, 'rating': 1})
+
+        stats = list(self.db.query('by_year'))[0]['value']
+        self.assertEqual(stats, {'sum': 45, 'count': 9, 'min': 1, 'max': 9, 'sumsqr': 285})
+
+        # Deleted documents drop out of the view
+        second = self.results[1]
+        self.db.destroy(second['id'], second['rev'])
+        self.assertEqual(list(self.db.query('by_year', reduce=False, key=1876)), [])
+        self.assertEqual(list(self.db.query('by_year'))[0]['value']['max'], 8)
+
+    def test_group(self):
+        self.db.define_view('by_year', by_year, '_count')
+
+        rows = list(self.db.query('by_year', group=True))
+        self.assertEqual(len(rows), 7)
+        self.assertEqual([row['value'] for row in rows if row['key'] == 2010], [2])
+
+        rows = list(self.db.query('by_year', key=2010))
+        self.assertEqual(rows, [{'key': None, 'value': 2}])
+
+    def test_reduce_range(self):
+        self.db.define_view('by_year', by_year, '_stats')
+
+        rows = list(self.db.query('by_year', startkey=1950, endkey=2010))
+        self.assertEqual(rows, [{'key': None, 'value': {'sum': 26, 'count': 5, 'min': 3, 'max': 8, 'sumsqr': 150}}])
+
+        rows = list(self.db.query('by_year', startkey=2010, endkey=1950, inclusive_end=False, descending=True, group=True))
+        self.assertEqual([(row['key'], row['value']['count']) for row in rows], [(2010, 2), (2007, 1), (1982, 1), (1969, 1)])
+
+    def test_group_level(self):
+        self.db.define_view('by_decade', by_decade, '_sum')
+
+        rows = list(self.db.query('by_decade', group_level=1))
+        self.assertEqual(rows, [
+            {'key': [1870], 'value': 9},
+            {'key': [1940], 'value': 10},
+            {'key': [1960], 'value': 5},
+            {'key': [1980], 'value': 3},
+            {'key': [2000], 'value': 4},
+            {'key': [2010], 'value': 21}
+        ])
+
+        rows = list(self.db.query('by_decade', group_level=2, startkey=[2010], endkey=[2010, {}]))
+        self.assertEqual(rows, [{'key': [2010, 2010], 'value': 14}, {'key': [2010, 2011], 'value': 7}])
+
+        rows = list(self.db.query('by_decade', group_level=1, descending=True, limit=1))
+        self.assertEqual(rows, [{'key': [2010], 'value': 21}])
+
+    def test_redefined(self):
+        self.db.define_view('ratings', by_year, '_count')
+        self.assertEqual(list(self.db.query('ratings'))[0]['value'], 8)
+
+        self.db.define_view('ratings', by_decade, '_sum')
+        self.assertEqual(list(self.db.query('ratings'))[0]['value'], 52)
+
+    def test_bad_view(self):
+        with self.assertRaises(SovocError):
+            self.db.define_view('no-good', by_year)
+        with self.assertRaises(SovocError):
+            self.db.define_view('by_year', by_year, '_median')
+        with self.assertRaises(SovocError):
+            list(self.db.query('missing'))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -16,19 +16,20 @@ cd && sudo rm -rf /tmp/sqlite-autoconf-3180000 /tmp/sqlite-autoconf-3180000.tar.
 
 # python3 via apt-get is too old
 # sudo apt-get install -yq libreadline-dev libsqlite3-dev libssl-dev
-sudo apt-get install -yq libreadline-dev libssl-dev
+# sovoc needs Python 3.11 or later (sqlite3 blobopen); its ssl module needs OpenSSL 1.1.1+
+sudo apt-get install -yq libreadline-dev libssl-dev libffi-dev zlib1g-dev libbz2-dev
 
-echo 'Install Python 3.6...'
+echo 'Install Python 3.11...'
 cd /tmp
-wget -O- https://www.python.org/ftp/python/3.6.1/Python-3.6.1.tgz | tar xz
-cd Python-3.6.1
+wget -O- https://www.python.org/ftp/python/3.11.9/Python-3.11.9.tgz | tar xz
+cd Python-3.11.9
 ./configure
 make
 sudo make altinstall
 
-cd && sudo rm -rf /tmp/Python-3.6.1
+cd && sudo rm -rf /tmp/Python-3.11.9
 
 echo 'Done!'
 
 cd /vagrant
-/usr/local/bin/python3.6 -m venv ./py3
+/usr/local/bin/python3.11 -m venv ./py3